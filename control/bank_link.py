@@ -0,0 +1,301 @@
+# asyncio transport for talking NSLC to the bank over a serial port.
+#
+# The bank is driven from the same event loop as the IRC bot, so frames are
+# decoded in data_received and replies go out without crossing threads.
+# pyserial-asyncio is used when installed. Otherwise the serial port's file
+# descriptor is watched directly on POSIX, and elsewhere (Windows, whose
+# proactor event loop has no add_reader) a thread blocks reading the port
+# and hands what it reads to the loop. open_pty() provides a
+# pseudo-terminal pair so the bank side can be simulated in tests.
+
+import os
+import sys
+import asyncio
+import threading
+import traceback
+import serial
+import nslc
+
+try:
+  import serial_asyncio
+except ImportError:
+  serial_asyncio = None
+
+def handle_exception():
+  print("Unexpected error:", sys.exc_info()[0:2])
+  traceback.print_tb(sys.exc_info()[2])
+
+
+class FdTransport(asyncio.Transport):
+  """ A minimal non-blocking transport over a tty or pty file descriptor """
+
+  def __init__(self, loop, fd, protocol, owner=None):
+    super().__init__()
+    self.loop = loop
+    self.fd = fd
+    self.protocol = protocol
+    self.owner = owner        # object owning the fd (e.g. a serial.Serial), closed with us
+    self.buffer = bytearray() # data the fd would not yet accept
+    self.closing = False
+    os.set_blocking(fd, False)
+    loop.add_reader(fd, self.read_ready)
+    loop.call_soon(protocol.connection_made, self)
+
+  def read_ready(self):
+    try:
+      data = os.read(self.fd, 65536)
+    except BlockingIOError:
+      return
+    except OSError as e:
+      self.fatal(e)
+      return
+    if data:
+      self.protocol.data_received(data)
+    else:
+      self.fatal(None)
+
+  def write(self, data):
+    if self.closing:
+      return
+    if not self.buffer:
+      try:
+        n = os.write(self.fd, data)
+      except BlockingIOError:
+        n = 0
+      except OSError as e:
+        self.fatal(e)
+        return
+      data = data[n:]
+      if not data:
+        return
+      self.loop.add_writer(self.fd, self.write_ready)
+    self.buffer += data
+
+  def write_ready(self):
+    try:
+      n = os.write(self.fd, self.buffer)
+    except BlockingIOError:
+      return
+    except OSError as e:
+      self.fatal(e)
+      return
+    del self.buffer[:n]
+    if not self.buffer:
+      self.loop.remove_writer(self.fd)
+
+  def get_write_buffer_size(self):
+    return len(self.buffer)
+
+  def is_closing(self):
+    return self.closing
+
+  def close(self):
+    self.fatal(None)
+
+  def fatal(self, exc):
+    if self.closing:
+      return
+    self.closing = True
+    self.loop.remove_reader(self.fd)
+    self.loop.remove_writer(self.fd)
+    if self.owner is not None:
+      self.owner.close()
+    else:
+      os.close(self.fd)
+    self.loop.call_soon(self.protocol.connection_lost, exc)
+
+
+class ThreadTransport(asyncio.Transport):
+  """ A transport over a serial.Serial whose reads block in a thread of their own,
+      for event loops that cannot watch the port (e.g the Windows proactor loop) """
+
+  def __init__(self, loop, port, protocol):
+    super().__init__()
+    self.loop = loop
+    self.port = port
+    self.protocol = protocol
+    self.closing = False
+    self.port.timeout = 0.1 # so the reader notices close() promptly
+    self.thread = threading.Thread(target=self.read_loop, daemon=True)
+    loop.call_soon(protocol.connection_made, self)
+    self.thread.start()
+
+  def read_loop(self):
+    while not self.closing:
+      try:
+        data = self.port.read(self.port.in_waiting or 1)
+      except Exception as e:
+        self.loop.call_soon_threadsafe(self.fatal, e)
+        return
+      if data:
+        self.loop.call_soon_threadsafe(self.data_ready, data)
+
+  def data_ready(self, data):
+    if not self.closing:
+      self.protocol.data_received(data)
+
+  def write(self, data):
+    if self.closing:
+      return
+    try:
+      self.port.write(data)
+    except Exception as e:
+      self.fatal(e)
+
+  def get_write_buffer_size(self):
+    return 0
+
+  def is_closing(self):
+    return self.closing
+
+  def close(self):
+    self.fatal(None)
+
+  def fatal(self, exc):
+    if self.closing:
+      return
+    self.closing = True
+    self.thread.join() # within a read timeout; the port can then be reopened at once
+    self.port.close()
+    self.loop.call_soon(self.protocol.connection_lost, exc)
+
+
+async def open_serial(loop, protocol_factory, port, baudrate):
+  """ Open a serial port as an asyncio (transport, protocol) pair """
+  if serial_asyncio is not None:
+    return await serial_asyncio.create_serial_connection(loop, protocol_factory, port,
+        baudrate=baudrate, bytesize=8, parity='N', stopbits=1)
+  if os.name != 'posix':
+    s = serial.Serial(port=port, baudrate=baudrate, bytesize=8, parity='N', stopbits=1)
+    protocol = protocol_factory()
+    return ThreadTransport(loop, s, protocol), protocol
+  s = serial.Serial(port=port, baudrate=baudrate, bytesize=8, parity='N', stopbits=1, timeout=0)
+  protocol = protocol_factory()
+  return FdTransport(loop, s.fileno(), protocol, owner=s), protocol
+
+def open_pty(loop, protocol_factory):
+  """ Connect a protocol to one end of a raw pseudo-terminal.
+      Returns (transport, protocol, fd) where fd is the other end, playing the bank. """
+  import tty # POSIX only
+  bank_end, our_end = os.openpty()
+  tty.setraw(our_end)
+  tty.setraw(bank_end)
+  protocol = protocol_factory()
+  return FdTransport(loop, our_end, protocol), protocol, bank_end
+
+
+COMMAND_TAGGED = 128  # see v2/pulse/constants.h
+
+class BankLink(asyncio.Protocol):
+  """ Speaks NSLC to the bank from an event loop, reconnecting when the link drops """
+
+  transport = None
+  is_up = False        # have we heard from the bank on this connection
+  is_running = True    # cleared by stop() to prevent reconnection
+  retry_interval = 2   # seconds between connection attempts
+  request_timeout = 2  # seconds to wait for the reply to a tagged request
+
+  def __init__(self, loop, port='COM3', baudrate=250000):
+    self.loop = loop
+    self.port = port
+    self.baudrate = baudrate
+    self.lc = nslc.NSLC()
+    self.lc.add_frame_handler(self.frame_received)
+    self.frame_handlers = []
+    self.pending = []    # frames queued whilst disconnected
+    self.requests = {}   # tag -> future awaiting the tagged reply
+    self.next_tag = 0
+
+  def add_error_handler(self, f):
+    self.lc.add_error_handler(f)
+
+  def add_frame_handler(self, f):
+    self.frame_handlers.append(f)
+
+  def frame_received(self, b):
+    # Tagged replies complete the matching request; anything else (including
+    # replies to requests that have already timed out) goes to the handlers.
+    if len(b) > 2 and b[0] == COMMAND_TAGGED:
+      future = self.requests.pop(b[1], None)
+      b = b[2:]
+      if future is not None and not future.done():
+        future.set_result(b)
+        return
+    for f in self.frame_handlers:
+      try:
+        f(b)
+      except:
+        handle_exception()
+
+  def allocate_tag(self):
+    for i in range(256):
+      tag = (self.next_tag + i) % 256
+      if tag not in self.requests:
+        self.next_tag = (tag + 1) % 256
+        return tag
+    raise RuntimeError("Too many outstanding bank requests")
+
+  def request(self, bytestring, timeout=None):
+    """ Send a command tagged with a fresh correlation byte.
+        Returns a future resolving to the (untagged) reply payload, or failing
+        with asyncio.TimeoutError. Requests can be pipelined freely. """
+    tag = self.allocate_tag()
+    future = self.loop.create_future()
+    self.requests[tag] = future
+    def expire():
+      if self.requests.get(tag) is future:
+        del self.requests[tag]
+      if not future.done():
+        future.set_exception(asyncio.TimeoutError())
+    self.loop.call_later(timeout or self.request_timeout, expire)
+    self.msg(bytes([COMMAND_TAGGED, tag]) + bytes(bytestring))
+    return future
+
+  def msg(self, bytestring):
+    frame = self.lc.frame(bytestring)
+    if self.transport is None or self.transport.is_closing():
+      self.pending.append(frame)
+    else:
+      self.transport.write(frame)
+
+  async def connect(self):
+    print("Connecting to bank...", end='')
+    sys.stdout.flush()
+    while self.is_running:
+      try:
+        await open_serial(self.loop, lambda: self, self.port, self.baudrate)
+        print("Connected to bank")
+        return
+      except:
+        handle_exception()
+        print(".",end='')
+        sys.stdout.flush()
+        await asyncio.sleep(self.retry_interval)
+
+  def start(self):
+    self.loop.create_task(self.connect())
+
+  def stop(self):
+    print("Closing connection to bank")
+    self.is_running = False
+    if self.transport is not None:
+      self.transport.close()
+
+  def connection_made(self, transport):
+    self.transport = transport
+    pending, self.pending = self.pending, []
+    for frame in pending:
+      transport.write(frame)
+
+  def data_received(self, data):
+    if not self.is_up:
+      print("Bank online")
+      self.is_up = True
+    self.lc.consume(data)
+
+  def connection_lost(self, exc):
+    self.transport = None
+    self.is_up = False
+    if self.is_running:
+      print("Lost connection to bank")
+      self.loop.create_task(self.connect())
@@ -1,11 +1,7 @@
-import bottom
-import nslc
-import threading
-import time
+import bot_runtime
+import bank_link
 import sys
 import traceback
-import serial
-import queue
 import asyncio
 import re
 
@@ -14,89 +10,6 @@ def handle_exception():
   traceback.print_tb(sys.exc_info()[2])
 
 
-class SerialThread(threading.Thread):
-  """Set up a thread to handle communication and error-recovery talking to the bank"""
-  connected = False       # is the bank presently connected
-  serial = None           # serial connection
-  is_running = True       # flag to allow easy remote termination of thread
-  lock = threading.Lock() # guard against data races accessing queue of messages to send
-  is_up = False           # is the bank up
-  q = queue.Queue()       # a queue of messages to send to the bank
-  def __init__(self):
-    super().__init__()
-    self.lc = nslc.NSLC()
-
-  def msg(self, bytestring):
-    self.lock.acquire()
-    bytes_to_send = self.lc.frame(bytestring)
-    self.q.put(bytes_to_send)
-    self.lock.release()
-
-  def is_up(self):
-    return self.is_up
-
-  def add_error_handler(self, f):
-    self.lc.add_error_handler(f)
-
-  def add_frame_handler(self, f):
-    self.lc.add_frame_handler(f)
-
-  def connect(self):
-    print("Connecting to bank...", end='')
-    sys.stdout.flush()
-    while(True):
-      try:
-        self.serial = serial.Serial(port=None, baudrate=250000,  bytesize=8, parity='N', stopbits=1)
-        self.serial.port='COM3'
-        self.serial.close()
-        self.serial.open()
-        self.connected = True
-        break;
-      except:
-        handle_exception()
-        print(".",end='')
-        sys.stdout.flush()
-        time.sleep(2)
-    print("Connected to bank")
-
-  def stop(self):
-    print("Closing connection to bank")
-    if (self.serial):
-      self.serial.close()
-    self.is_running = False
-
-  def run(self):
-    while(self.is_running):
-      # ensure we're connected
-      if not self.connected:
-        self.is_up = False
-        self.connect()
-      try:
-        # consume the next byte from the device
-        if self.serial.in_waiting > 0:
-          if (not self.is_up):
-            print("Bank online")
-            self.is_up = True
-          self.lc.consume(self.serial.read())
-      except:
-        handle_exception()
-        self.connected = False
-        self.is_up = False
-        self.serial.close()
-        self.connect()
-      # any messages to send the device?
-      if (self.connected):
-        if not self.q.empty():
-          self.lock.acquire()
-          m = self.q.get()
-          try:
-            self.serial.write(m)
-          except:
-            self.q.put(m)
-            handle_exception()
-          self.lock.release()
-
-
 host = '192.168.137.3'
 port = 6667
 ssl = False
@@ -122,7 +35,8 @@ command_codes = {
   'dry_run' : 4,
   'charge': 8,
   'pulse': 16,
-  'abort' : 32
+  'abort' : 32,
+  'set_timings' : 64
 }
 
 response_codes = {
@@ -192,107 +106,131 @@ def make_set_cmd(elems):
     handle_exception()
     return None
 
+request_id_pattern = re.compile(r'\s+#(\d+)$')  # optional trailing request id
+
 def sysmsg(b, s):
   b.send("PRIVMSG", target=CHANNEL, message=s)
 
-serial_thread = SerialThread()
-
 def notify_parse_error(b,target):
   sysmsg(b,"Could not parse that. type '%s: help' for help"%NICK)
 
-def handle_privmsg(cmd,target,b):
-  elems = re.split('\s+',cmd)
-  if elems[0] == 'help':
-    sysmsg(b,"Usage instructions for %s:"%NICK)
-    sysmsg(b,"  -- SUPPORTED COMMANDS -- ")
-    for k in command_codes:
-      sysmsg(b,"    %s"%k)
-    sysmsg(b,"  -- SUPPORTED PARAMETERS ( use with get / set )-- ")
-    for k in parameter_codes:
-      sysmsg(b,"    %s"%k)
-
-    sysmsg(b," -- EXAMPLES -- ")
-    sysmsg(b,"'%s: get hv_voltage'    : retrieve bank HV voltage"%NICK)
-    sysmsg(b,"'%s: charge 100'        : charges bank to 100V"%NICK)
-    sysmsg(b,"%s is case-insensitive and understands some symbolic names"%NICK)
-    sysmsg(b,"e.g '%s: set charge_enable on' and '%s: set CHARGE_EnAble 1'  will both work fine"%(NICK,NICK))
-    return
-
-  if elems[0] == 'reset':
-    serial_thread.msg( bytes([ command_codes['reset']]))
-    return
-
-  if elems[0] == 'stop':
-    serial_thread.msg( bytes([ command_codes['abort']]))
-    return
-
-  if elems[0] == 'abort':
-    serial_thread.msg( bytes([ command_codes['abort']]))
-    return
-
-  if elems[0] == 'pulse':
-    if len(elems) > 1:
-      sysmsg(b, "'pulse' takes no arguments")
-    else:
-      serial_thread.msg( bytes([ command_codes['pulse']]))
-    return
+def bank_help(elems, request_id):
+  lines = [ "Usage instructions for %s:"%NICK ]
+  lines.append("  -- SUPPORTED COMMANDS -- ")
+  for k in command_codes:
+    lines.append("    %s"%k)
+  lines.append("  -- SUPPORTED PARAMETERS ( use with get / set )-- ")
+  for k in parameter_codes:
+    lines.append("    %s"%k)
+
+  lines.append(" -- EXAMPLES -- ")
+  lines.append("'%s: get hv_voltage'    : retrieve bank HV voltage"%NICK)
+  lines.append("'%s: charge 100'        : charges bank to 100V"%NICK)
+  lines.append("'%s: set_timings 10 200 10 200 10 200 10 200 0 50' : sets pulse delay and width for banks 1-5 at once"%NICK)
+  lines.append("%s is case-insensitive and understands some symbolic names"%NICK)
+  lines.append("e.g '%s: set charge_enable on' and '%s: set CHARGE_EnAble 1'  will both work fine"%(NICK,NICK))
+  lines.append("End a command with '#<N>' (e.g '%s: get hv_voltage #7') and its reply will end with '#<N>' too"%NICK)
+  bot.sysmsg_lines(lines)
+
+def reset(elems, request_id):
+  send_command( bytes([ command_codes['reset']]), request_id)
+
+def abort(elems, request_id):
+  bank.msg( bytes([ command_codes['abort']]))
+
+def pulse(elems, request_id):
+  if len(elems) > 1:
+    sysmsg(bot, "'pulse' takes no arguments")
+  else:
+    send_command( bytes([ command_codes['pulse']]), request_id)
 
-  if elems[0] == 'dry_run':
-    if len(elems) < 2:
-      sysmsg(b, "dry_run expects one of 'true', 'false', '1' or '0' as arguments")
-      return
-    try:
-      v = int(symbolic_names[elems[1]])
-      serial_thread.msg( bytes( [ command_codes['dry_run'], v ] ))
-    except:
-      handle_exception()
-      sysmsg(b, "ERROR: could not understand that")
+def dry_run(elems, request_id):
+  if len(elems) < 2:
+    sysmsg(bot, "dry_run expects one of 'true', 'false', '1' or '0' as arguments")
     return
+  try:
+    v = int(symbolic_names[elems[1]])
+    send_command( bytes( [ command_codes['dry_run'], v ] ), request_id)
+  except:
+    handle_exception()
+    sysmsg(bot, "ERROR: could not understand that")
 
-  if elems[0] == 'charge':
-    if len(elems) < 2:
-      sysmsg(b, "charge expects an (integer) voltage as argument")
-      return
-    try:
-      v = int(elems[1])
-      serial_thread.msg(bytes([ command_codes['charge'], int(v/256), int(v % 256)]))
-    except:
-      handle_exception()
-      sysmsg(b, "charge expects an (integer) voltage as argument")
+def charge(elems, request_id):
+  if len(elems) < 2:
+    sysmsg(bot, "charge expects an (integer) voltage as argument")
     return
+  try:
+    v = int(elems[1])
+    send_command(bytes([ command_codes['charge'], int(v/256), int(v % 256)]), request_id)
+  except:
+    handle_exception()
+    sysmsg(bot, "charge expects an (integer) voltage as argument")
 
-  if elems[0] == 'get':
-    if len(elems) < 2:
-       notify_parse_error(b,target)
-    try:
-      command_bytes =  make_get_cmd(elems)
-      if (command_bytes != None):
-        serial_thread.msg( command_bytes )
-      else:
-        notify_parse_error(b,target)
-    except:
-      handle_exception()
-      notify_parse_error(b,target)
+def set_timings(elems, request_id):
+  if len(elems) != 11:
+    sysmsg(bot, "set_timings expects a pulse delay and width (in ms) for each of the 5 banks: d1 w1 d2 w2 ... d5 w5")
     return
+  try:
+    v = [ int(e) for e in elems[1:] ]
+    send_command( bytes( [ command_codes['set_timings'] ] + v ), request_id)
+  except:
+    handle_exception()
+    sysmsg(bot, "ERROR: set_timings expects integers between 0 and 255")
 
-  if elems[0] == 'set':
-    if len(elems) < 3:
-       notify_parse_error(b,target)
+def get_or_set(make_cmd, min_elems):
+  def handler(elems, request_id):
+    if len(elems) < min_elems:
+       notify_parse_error(bot,CHANNEL)
     try:
-      command_bytes =  make_set_cmd(elems)
+      command_bytes =  make_cmd(elems)
       if (command_bytes != None):
-        serial_thread.msg( command_bytes )
+        send_command( command_bytes, request_id )
       else:
-        notify_parse_error(b,target)
+        notify_parse_error(bot,CHANNEL)
     except:
       handle_exception()
-      notify_parse_error(b,target)
-    return
+      notify_parse_error(bot,CHANNEL)
+  return handler
+
+bank_commands = {
+  'help' : bank_help,
+  'reset' : reset,
+  'stop' : abort,
+  'abort' : abort,
+  'pulse' : pulse,
+  'dry_run' : dry_run,
+  'charge' : charge,
+  'set_timings' : set_timings,
+  'get' : get_or_set(make_get_cmd, 2),
+  'set' : get_or_set(make_set_cmd, 3),
+}
 
-  notify_parse_error(b, target)
+def bank_command(name, f):
+  """ Adapt f(elems, request_id) to a BotRuntime command: the whole command is
+      lower case, and split into words after any trailing '#<N>' is removed """
+  def handler(args):
+    cmd = (name + ' ' + args).strip().lower()
+    request_id = None
+    m = request_id_pattern.search(cmd)
+    if m:
+      request_id = m.group(1)
+      cmd = cmd[:m.start()]
+    f(re.split('\s+',cmd), request_id)
+  return handler
+
+def emergency_stop(nick, target, message):
+  if message.startswith('STOP'):
+    bank.msg( bytes([ command_codes['reset']]))
+    return True
+  return False
 
 
-bot = bottom.Client(host=host, port=port, ssl=ssl)
+bot = bot_runtime.BotRuntime(NICK, 'stepper control IRC bot', CHANNEL, host, port, ssl)
+bot.unknown_command = lambda word, args: notify_parse_error(bot, CHANNEL)
+bot.add_message_handler(emergency_stop)
+for name, f in bank_commands.items():
+  bot.add_command(name, '', bank_command(name, f))
+bank = bank_link.BankLink(bot.loop, port='COM3', baudrate=250000)
 
 def grab_name(byte, d):
   r = ''
@@ -303,9 +241,10 @@ def grab_name(byte, d):
   return r
 
 
-def handle_bank_message(b):
+def describe_bank_message(b):
+  """ Render a message from the bank as lines of text for the channel """
   if b == b'U':    # Bank heartbeat
-    pass
+    return []
   else:
     if len(b) == 5:  # Is a response message
       if (b[0] == 99):  # switch-state change message
@@ -313,18 +252,18 @@ def handle_bank_message(b):
         old_state = grab_name(b[2], switch_codes)
         new_state = grab_name(b[4], switch_codes)
         if ( switch == 6 ):
-          bot.send("PRIVMSG", target=CHANNEL, message="HV BIAS switch change from %s to %s"%(old_state,new_state))
+          return ["HV BIAS switch change from %s to %s"%(old_state,new_state)]
         else:
-          bot.send("PRIVMSG", target=CHANNEL, message="Bank %d switch change from %s to %s"%(switch,old_state,new_state))
+          return ["Bank %d switch change from %s to %s"%(switch,old_state,new_state)]
       else:
         cmd = grab_name(b[0], command_codes)
         parameter = grab_name(b[1], parameter_codes)
         response = grab_name(b[2], response_codes)
         val = 256*b[3] + b[4]
         if response == 'OK':
-          bot.send("PRIVMSG",target=CHANNEL, message="%s %s: %s, value = %d"%(cmd, parameter, response, val))
+          return ["%s %s: %s, value = %d"%(cmd, parameter, response, val)]
         else:
-          bot.send("PRIVMSG",target=CHANNEL, message="%s %s: ERROR %s, value = %d"%(cmd, parameter, response, val))
+          return ["%s %s: ERROR %s, value = %d"%(cmd, parameter, response, val)]
 
     else:
       if (len(b) > 2):
@@ -334,62 +273,68 @@ def handle_bank_message(b):
           result = 'Switch states: '
           for v in b[2:]:
             result += grab_name(v, switch_codes) + " "
-          bot.send("PRIVMSG",target=CHANNEL, message=result)
-          return
+          return [result]
         elif cmd == 'get' and parameter == 'bank_voltage':
-          result = "LOWER: "  
+          lower = "LOWER: "  
           for i in range(4):
-            result += str( b[2*i+2]*256 + b[2*i+3] ) + "V "
-          bot.send("PRIVMSG",target=CHANNEL, message=result)
-          result = "UPPER: "  
+            lower += str( b[2*i+2]*256 + b[2*i+3] ) + "V "
+          upper = "UPPER: "  
           for i in range(4):
-            result += str( b[2*i+10]*256 + b[2*i+11] ) + "V "
-          bot.send("PRIVMSG",target=CHANNEL, message=result)
+            upper += str( b[2*i+10]*256 + b[2*i+11] ) + "V "
+          return [lower, upper]
+  return []
+
+def bank_event(b):
+  """ The fields of a message from the bank, as arguments for BotRuntime.publish """
+  if len(b) == 5:
+    if (b[0] == 99):
+      return dict(command='switch_change', result=grab_name(b[4], switch_codes),
+                  switch=b[1], old=grab_name(b[2], switch_codes))
+    return dict(command=grab_name(b[0], command_codes), parameter=grab_name(b[1], parameter_codes),
+                result=grab_name(b[2], response_codes), value=256*b[3] + b[4])
+  cmd = grab_name(b[0], command_codes)
+  parameter = grab_name(b[1], parameter_codes)
+  if parameter == 'switch_state':
+    value = [ grab_name(v, switch_codes) for v in b[2:] ]
+  else:
+    value = [ 256*b[i] + b[i+1] for i in range(2, len(b) - 1, 2) ]
+  return dict(command=cmd, parameter=parameter, result='OK', value=value)
+
+def handle_bank_message(b):
+  # replies go ahead of anything else queued, as sequences wait on them;
+  # multi-line replies (bank_voltage) go as one message
+  lines = describe_bank_message(b)
+  if lines:
+    bot.report(bot.separator.join(lines), **bank_event(b))
+
+def send_command(command_bytes, request_id=None):
+  """ Send a command to the bank. Given a request_id, the command is tagged and
+      its reply is posted with ' #<request_id>' appended, so several commands
+      can be in flight at once and each reply matched to its request. """
+  if request_id is None:
+    bank.msg(command_bytes)
+    return
+  def reply(future):
+    try:
+      b = future.result()
+      lines = describe_bank_message(b)
+      event = bank_event(b) if lines else None
+    except asyncio.TimeoutError:
+      lines = ["ERROR: no reply from bank"]
+      event = dict(command=grab_name(command_bytes[0], command_codes), result='NO_REPLY')
+    if lines:
+      bot.report("%s #%s"%(bot.separator.join(lines), request_id), id=request_id, **event)
+  bank.request(command_bytes).add_done_callback(reply)
 
 def handle_invalid_frame(b):
   print("Found invalid frame %s"%b)
 
-serial_thread.add_frame_handler(handle_bank_message)
-serial_thread.add_error_handler(handle_invalid_frame)
-serial_thread.start()
-
-
-@bot.on('CLIENT_CONNECT')
-def connect(**kwargs):
-  print("Connected to IRC server")
-  bot.send('NICK', nick=NICK)
-  bot.send('USER', user=NICK,
-    realname='stepper control IRC bot')
-  bot.send('JOIN', channel=CHANNEL)
-
-@bot.on("client_disconnect")
-async def reconnect(**kwargs):
-  print("Lost connection to IRC server")
-  await asyncio.sleep(3, loop=bot.loop)
-  bot.loop.create_task(bot.connect())
-
-@bot.on('PING')
-def keepalive(message, **kwargs):
-  bot.send('PONG', message=message)
-
-@bot.on('PRIVMSG')
-def message(nick, target, message, **kwargs):
-
-  if nick == NICK:
-    return
-
-  if message.startswith('STOP'):
-    serial_thread.msg( bytes([ command_codes['reset']]))
-    return
+bank.add_frame_handler(handle_bank_message)
+bank.add_error_handler(handle_invalid_frame)
 
-  if message.startswith(NICK + ': '):
-    stripped = message.split(NICK+': ')
-    if len(stripped) > 1:
-      cmd = ''.join(stripped)
-      handle_privmsg(cmd.strip().lower(),target,bot)
 
 try:
-  bot.loop.create_task(bot.connect())
-  bot.loop.run_forever()
+  bank.start()
+  bot.run()
 finally:
-  serial_thread.stop()
\ No newline at end of file
+  bank.stop()
\ No newline at end of file
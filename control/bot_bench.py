@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+# Messages/sec benchmark for BotRuntime against a local fake IRC server.
+#
+# Usage:  python bot_bench.py [N_MESSAGES] [SLOW_EVERY] [SLOW_MS]
+#
+# The server registers the bot, then sends N_MESSAGES '<nick>: echo <i>'
+# lines, with every SLOW_EVERY'th one a '<nick>: slow' command that blocks
+# for SLOW_MS (as writing a file or reading an instrument would), and times
+# how long it takes for every echo to come back. A bot written the way the
+# bots used to be (split/join parsing, handlers on the event loop) is
+# compared with one built on BotRuntime, with send pacing turned off.
+#
+# Then, with pacing on, a bot is asked for a long help listing immediately
+# followed by a command whose 'OK' a sequence would be waiting for; the time
+# until the OK arrives is compared for a first-come first-served queue and
+# for BotRuntime's priorities and coalescing.
+#
+# Finally, if pyzmq is installed, the time from publishing an event on the
+# bot bus to a subscriber's callback is measured through a local forwarder.
+
+import sys
+import time
+import queue
+import asyncio
+import threading
+import bottom
+import bot_runtime
+import bot_bus
+
+NICK = "bench"
+
+class FakeServer:
+  """ Accepts one bot, floods it with commands and counts the replies """
+
+  def __init__(self, loop, n, slow_every):
+    self.loop = loop
+    self.n = n
+    self.slow_every = slow_every
+    self.done = loop.create_future()
+
+  async def handle(self, reader, writer):
+    while not (await reader.readline()).startswith(b'JOIN'):
+      pass
+    writer.write(b':server 001 %s :Welcome\r\n'%NICK.encode())
+    t0 = time.perf_counter()
+    for i in range(self.n):
+      command = 'slow' if self.slow_every and i % self.slow_every == 0 else 'echo %d'%i
+      writer.write((':op!op@host PRIVMSG #system :%s: %s\r\n'%(NICK, command)).encode())
+    writer.write(b'PING :server\r\n')
+    expected = set(str(i) for i in range(self.n) if not (self.slow_every and i % self.slow_every == 0))
+    pong = None
+    while expected or pong is None:
+      line = (await reader.readline()).decode().strip()
+      if line.startswith('PONG'):
+        pong = time.perf_counter() - t0
+      elif line.startswith('PRIVMSG'):
+        expected.discard(line.rsplit(':', 1)[1])
+    self.done.set_result((time.perf_counter() - t0, pong))
+    writer.close()
+
+def legacy_bot(loop, server_port, slow, n):
+  """ The pattern every bot used: parse with split/join, call the handler inline """
+  bot = bottom.Client(host='127.0.0.1', port=server_port, ssl=False, loop=loop)
+  def echo(message):
+    bot.send("PRIVMSG", target="#system", message=message)
+  commands = { 'echo' : ('echo', echo), 'slow' : ('slow', lambda m: slow()) }
+  @bot.on('CLIENT_CONNECT')
+  def connect(**kwargs):
+    bot.send('NICK', nick=NICK)
+    bot.send('USER', user=NICK, realname=NICK)
+    bot.send('JOIN', channel="#system")
+  @bot.on('PING')
+  def keepalive(message, **kwargs):
+    bot.send('PONG', message=message)
+  @bot.on('PRIVMSG')
+  def message(nick, target, message, **kwargs):
+    if nick == NICK:
+      return
+    if not message.startswith(NICK + ': '):
+      return
+    stripped = ''.join(message.split(NICK+': ')[1:]).strip()
+    elems = stripped.split()
+    if elems[0] in commands.keys():
+      commands[elems[0]][1]( ' '.join(elems[1:]))
+  loop.create_task(bot.connect())
+
+def runtime_bot(loop, server_port, slow, n):
+  bot = bot_runtime.BotRuntime(NICK, host='127.0.0.1', port=server_port, workers=8)
+  bot.send_rate = None
+  bot.max_queue = n # the flood arrives faster than the queue is looked at
+  bot.add_command('echo', 'echo', bot.sysmsg)
+  bot.add_command('slow', 'slow', lambda m: slow(), blocking=True)
+  bot.start()
+  return bot
+
+class HelpThenOkServer:
+  """ Asks for n_lines of help and then for an OK, and times both """
+
+  def __init__(self, loop):
+    self.loop = loop
+    self.done = loop.create_future()
+
+  async def handle(self, reader, writer):
+    while not (await reader.readline()).startswith(b'JOIN'):
+      pass
+    writer.write(b':server 001 %s :Welcome\r\n'%NICK.encode())
+    writer.write((':op!op@host PRIVMSG #system :%s: help\r\n'%NICK).encode())
+    writer.write((':op!op@host PRIVMSG #system :%s: ok\r\n'%NICK).encode())
+    t0 = time.perf_counter()
+    ok = end = None
+    lines = 0
+    while ok is None or end is None:
+      line = (await reader.readline()).decode().strip()
+      if not line.startswith('PRIVMSG'):
+        continue
+      lines += 1
+      if line.endswith(':OK'):
+        ok = time.perf_counter() - t0
+      elif line.endswith('the end'):
+        end = time.perf_counter() - t0
+    self.done.set_result((ok, end, lines))
+    writer.close()
+
+def help_lines(n_lines):
+  return [ '  command_%d : does something useful with its arguments'%i for i in range(n_lines) ] + [ 'the end' ]
+
+def fifo_bot(loop, server_port, n_lines, rate):
+  """ Paced, but everything in order of arrival and one line per message """
+  bot = bot_runtime.BotRuntime(NICK, host='127.0.0.1', port=server_port)
+  bot.send_rate = rate
+  bot.add_command('help', 'help', lambda m: [ bot.sysmsg(s) for s in help_lines(n_lines) ])
+  bot.add_command('ok', 'ok', lambda m: bot.sysmsg('OK'))
+  bot.start()
+  return bot
+
+def priority_bot(loop, server_port, n_lines, rate):
+  bot = bot_runtime.BotRuntime(NICK, host='127.0.0.1', port=server_port)
+  bot.send_rate = rate
+  bot.add_command('help', 'help', lambda m: bot.sysmsg_lines(help_lines(n_lines)))
+  bot.add_command('ok', 'ok', lambda m: bot.sysmsg('OK', bot_runtime.CONTROL))
+  bot.start()
+  return bot
+
+def run(make_bot, n, slow_every, slow_ms):
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  server = FakeServer(loop, n, slow_every)
+  listener = loop.run_until_complete(asyncio.start_server(server.handle, '127.0.0.1', 0))
+  bot = make_bot(loop, listener.sockets[0].getsockname()[1], lambda: time.sleep(slow_ms / 1000), n)
+  return finish(loop, listener, bot, server.done)
+
+def run_help(make_bot, n_lines, rate):
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  server = HelpThenOkServer(loop)
+  listener = loop.run_until_complete(asyncio.start_server(server.handle, '127.0.0.1', 0))
+  bot = make_bot(loop, listener.sockets[0].getsockname()[1], n_lines, rate)
+  return finish(loop, listener, bot, server.done) + (bot,)
+
+def finish(loop, listener, bot, done):
+  result = loop.run_until_complete(done)
+  if bot is not None:
+    bot.is_running = False # don't reconnect when the server hangs up
+  listener.close()
+  tasks = asyncio.all_tasks(loop)
+  for task in tasks:
+    task.cancel()
+  loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+  loop.close()
+  return result
+
+def bus_latency(n):
+  """ Publish n events one at a time, timing each round trip through the forwarder """
+  threading.Thread(target=bot_bus.forward, args=('127.0.0.1',), daemon=True).start()
+  received = queue.Queue()
+  subscriber = bot_bus.Subscriber(lambda event: received.put(time.perf_counter()), host='127.0.0.1')
+  subscriber.start()
+  publisher = bot_bus.Publisher('bank', '127.0.0.1')
+  while received.empty(): # until the subscription has reached the forwarder
+    publisher.publish('get', 'OK')
+    time.sleep(0.05)
+  time.sleep(0.1)
+  while not received.empty():
+    received.get()
+  latencies = []
+  for i in range(n):
+    t0 = time.perf_counter()
+    publisher.publish('charge', 'OK', 0, str(i), 'charge : OK, value = 0 #%d'%i, parameter='')
+    latencies.append(received.get() - t0)
+  latencies.sort()
+  return latencies[n // 2], latencies[n * 99 // 100]
+
+def main():
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  slow_every = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+  slow_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 200
+  if slow_every:
+    print("%d messages, a %g ms command every %d"%(n, slow_ms, slow_every))
+  else:
+    print("%d messages"%n)
+  for label, make_bot in [ ('legacy handlers', legacy_bot), ('BotRuntime', runtime_bot) ]:
+    elapsed, pong = run(make_bot, n, slow_every, slow_ms)
+    print("  %-16s: %8.0f messages/sec, PONG after %.3f s"%(label, n / elapsed, pong))
+  n_lines, rate = 40, 20.0
+  print("%d lines of help then an OK, sent at %g messages/sec after a burst of %d"%(n_lines, rate, bot_runtime.BotRuntime.send_burst))
+  for label, make_bot in [ ('in order', fifo_bot), ('BotRuntime', priority_bot) ]:
+    ok, elapsed, lines, bot = run_help(make_bot, n_lines, rate)
+    print("  %-16s: OK after %.3f s, help in %d messages after %.3f s (queue reached %d)"%(label, ok, lines - 1, elapsed, bot.max_depth))
+  if bot_bus.available():
+    median, p99 = bus_latency(1000)
+    print("Bot bus: published to received in %.3f ms (median), %.3f ms (99th percentile)"%(1000*median, 1000*p99))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# A ZeroMQ publish/subscribe bus for traffic between the bots.
+#
+# IRC stays the place for people to give commands and read replies, but
+# what a bot says there is meant to be read, not parsed, and it arrives
+# behind the send queue's pacing. Bots also publish each result on the
+# bus as a structured event:
+#
+#   { 'device'  : the publishing bot's nick, e.g 'bank',
+#     'command' : the command the event concerns, e.g 'charge',
+#     'id'      : the request id it answers (the '#<N>' of a tagged command), or None,
+#     'params'  : a dict of anything else about the command,
+#     'result'  : a result code, e.g 'OK' or 'TIMED_OUT',
+#     'value'   : the value returned, if any,
+#     'text'    : the line posted to IRC alongside, if any,
+#     'time'    : when it was published (seconds since the epoch) }
+#
+# Each event is sent as two frames: the device name, so that subscribers
+# can filter on it, and the event as JSON.
+#
+# A bot that publishes an event usually posts its text to IRC too, so a
+# listener on both hears it twice, in either order. Subscribers match the
+# two copies up by device and request id (or, for untagged events, by
+# text): a subscriber's callback gets each event with its text set to None
+# if the IRC copy came first, and irc_copy() says whether an IRC line
+# repeats an event already delivered.
+#
+# Publishers and subscribers all connect to a forwarder, started with
+#
+#   python bot_bus.py
+#
+# on the IRC server's machine. pyzmq is optional: without it publish() does
+# nothing and subscribers never hear anything, so everything still works
+# over IRC alone.
+
+import re
+import sys
+import time
+import json
+import collections
+import threading
+import traceback
+
+try:
+  import zmq
+except ImportError:
+  zmq = None
+
+host = '192.168.137.3'
+publish_port = 5555    # publishers connect here
+subscribe_port = 5556  # subscribers connect here
+
+def handle_exception():
+  print("Unexpected error:", sys.exc_info()[0:2])
+  traceback.print_tb(sys.exc_info()[2])
+
+def available():
+  return zmq is not None
+
+
+class Publisher:
+  """ Publishes events for one device. Safe to use from any thread. """
+
+  def __init__(self, device, host=host, port=publish_port):
+    self.device = device
+    self.lock = threading.Lock()
+    self.socket = None
+    if zmq is not None:
+      self.socket = zmq.Context.instance().socket(zmq.PUB)
+      self.socket.setsockopt(zmq.LINGER, 0)
+      self.socket.connect("tcp://%s:%d"%(host, port))
+
+  def publish(self, command, result=None, value=None, id=None, text=None, **params):
+    if self.socket is None:
+      return
+    event = { 'device' : self.device, 'command' : command, 'id' : id, 'params' : params,
+              'result' : result, 'value' : value, 'text' : text, 'time' : time.time() }
+    with self.lock:
+      self.socket.send_multipart([ self.device.encode(), json.dumps(event).encode() ])
+
+  def close(self):
+    if self.socket is not None:
+      self.socket.close()
+
+
+class Subscriber(threading.Thread):
+  """ Calls callback(event) from its own thread for every event published
+      by the given devices (or by every device) """
+
+  def __init__(self, callback, devices=None, host=host, port=subscribe_port, max_age=60):
+    super().__init__(daemon=True)
+    self.callback = callback
+    self.max_age = max_age  # seconds a copy waits for its twin before being forgotten
+    self.lock = threading.Lock()
+    self.unmatched = dict() # key -> (route, deque of arrival times) of copies heard by one route only
+    self.socket = None
+    if zmq is not None:
+      self.socket = zmq.Context.instance().socket(zmq.SUB)
+      self.socket.setsockopt(zmq.LINGER, 0)
+      for device in (devices or [ '' ]):
+        self.socket.setsockopt(zmq.SUBSCRIBE, device.encode())
+      self.socket.connect("tcp://%s:%d"%(host, port))
+
+  def key(self, device, text, id=None):
+    if id is None:
+      m = re.search(r'\s#(\d+)$', text)
+      if m:
+        id = m.group(1)
+    if id is not None:
+      return (device, 'id', str(id))
+    return (device, 'text', text)
+
+  def first_copy(self, route, device, text, id=None):
+    """ False if this copy of an event is the twin of one already heard by the
+        other route ('bus' or 'irc'); copies are matched up in arrival order """
+    key = self.key(device, text, id)
+    now = time.time()
+    with self.lock:
+      if len(self.unmatched) > 1000:
+        for k, (r, times) in list(self.unmatched.items()):
+          if times[-1] < now - self.max_age:
+            del self.unmatched[k]
+      r, times = self.unmatched.get(key, (route, None))
+      while times and times[0] < now - self.max_age:
+        times.popleft()
+      if times and r != route:
+        times.popleft()
+        if not times:
+          del self.unmatched[key]
+        return False
+      if not times:
+        times = collections.deque()
+        self.unmatched[key] = (route, times)
+      times.append(now)
+      return True
+
+  def irc_copy(self, nick, message):
+    """ is message, posted to IRC by nick, a copy of an event already delivered? """
+    if self.socket is None:
+      return False
+    return not self.first_copy('irc', nick, message)
+
+  def run(self):
+    if self.socket is None:
+      return
+    while True:
+      try:
+        topic, payload = self.socket.recv_multipart()
+        event = json.loads(payload.decode())
+      except zmq.ContextTerminated:
+        return
+      except:
+        handle_exception()
+        continue
+      if event['text'] is not None and not self.first_copy('bus', event['device'], event['text'], event['id']):
+        event['text'] = None # already heard over IRC
+      try:
+        self.callback(event)
+      except:
+        handle_exception()
+
+
+def forward(host='*', publish_port=publish_port, subscribe_port=subscribe_port):
+  """ Relay everything published to every subscriber; runs forever """
+  context = zmq.Context.instance()
+  frontend = context.socket(zmq.XSUB)
+  frontend.bind("tcp://%s:%d"%(host, publish_port))
+  backend = context.socket(zmq.XPUB)
+  backend.bind("tcp://%s:%d"%(host, subscribe_port))
+  zmq.proxy(frontend, backend)
+
+if __name__ == '__main__':
+  if zmq is None:
+    sys.exit("The bus needs pyzmq (pip install pyzmq)")
+  print("Forwarding events from port %d to port %d"%(publish_port, subscribe_port))
+  forward()
@@ -0,0 +1,360 @@
+# IRC plumbing shared by the control bots.
+#
+# BotRuntime connects to the IRC server and joins the channel, answers PINGs,
+# pings a server that has gone quiet, and reconnects with exponential backoff
+# when the connection drops. Messages addressed to the bot ("<nick>: <command>
+# <args>") are dispatched on their first word through a dict of commands;
+# commands that may block (disk, network, instruments) run in a thread pool
+# so the event loop keeps servicing the connection. send() and sysmsg() may
+# be called from any thread.
+#
+# Outgoing messages wait in a priority queue, so replies the sequencer is
+# waiting for go out ahead of help text, and leave at a rate set by a token
+# bucket rather than tripping the server's flood protection. Chatter lines
+# queued together are sent joined into as few messages as fit.
+#
+# Results other bots act on are also published as structured events on the
+# bot_bus, when pyzmq is installed, which skips both the queue and parsing.
+
+import sys
+import time
+import heapq
+import asyncio
+import traceback
+import concurrent.futures
+import bottom
+import bot_bus
+
+host = '192.168.137.3'
+port = 6667
+ssl = False
+
+CHANNEL = "#system"
+
+# send priorities; lower goes first
+CONTROL = 0   # replies and commands other bots are waiting for
+REPLY = 1     # other responses to commands
+CHATTER = 2   # help and status listings, which may be coalesced
+
+unqueued = { 'PONG', 'PING', 'NICK', 'USER', 'JOIN', 'QUIT' } # sent immediately
+
+def handle_exception():
+  print("Unexpected error:", sys.exc_info()[0:2])
+  traceback.print_tb(sys.exc_info()[2])
+
+
+class BotRuntime:
+  """ One IRC bot: its connection, its commands, and a pool for slow handlers """
+
+  min_backoff = 1      # seconds before the first reconnection attempt
+  max_backoff = 60     # the delay doubles after each failure, up to this
+  ping_interval = 120  # seconds of silence from the server before we ping it
+  ping_timeout = 60    # further seconds of silence before the connection is given up
+  send_rate = 2.0      # messages per second once the burst is used up; None for no pacing
+  send_burst = 8       # messages that may be sent back to back
+  max_queue = 1000     # messages beyond this are dropped
+  max_message = 400    # characters in a message made by joining chatter lines
+  separator = ' | '
+
+  def __init__(self, nick, realname='', channel=CHANNEL, host=host, port=port, ssl=ssl, workers=4):
+    self.nick = nick
+    self.realname = realname or nick
+    self.channel = channel
+    self.prefix = nick + ': '
+    self.client = bottom.Client(host=host, port=port, ssl=ssl)
+    self.loop = self.client.loop
+    self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+    self.bus = bot_bus.Publisher(nick, host)
+    self.commands = dict()         # first word -> (help, handler(args), blocking)
+    self.message_handlers = []     # f(nick, target, message), returning True if it consumed the message
+    self.connect_handlers = []
+    self.disconnect_handlers = []
+    self.backoff = self.min_backoff
+    self.last_heard = self.loop.time()
+    self.is_running = True
+    self.registered = False
+    self.queue = []                # heap of (priority, seq, queued_at, command, kwargs, coalesce)
+    self.seq = 0
+    self.tokens = self.send_burst
+    self.last_refill = time.perf_counter()
+    self.queue_ready = asyncio.Event()
+    self.max_depth = 0
+    self.sent = 0
+    self.lines_sent = 0
+    self.dropped = 0
+    self.latency = { p : [ 0, 0.0, 0.0 ] for p in (CONTROL, REPLY, CHATTER) } # count, total, max
+    self.client.raw_handlers.insert(0, self.heard)
+    self.client.on('CLIENT_CONNECT', self.connected)
+    self.client.on('CLIENT_DISCONNECT', self.disconnected)
+    self.client.on('RPL_WELCOME', self.welcomed)
+    self.client.on('PING', self.keepalive)
+    self.client.on('PRIVMSG', self.privmsg)
+    self.add_command('help', 'shows this useful message', self.usage)
+    self.add_command('send_stats', 'shows the outgoing queue depth and how long messages waited in it', self.send_stats)
+
+  # -- commands
+
+  def add_command(self, name, help, handler, blocking=False):
+    """ Call handler(args) for '<nick>: <name> <args>'; in the thread pool if blocking """
+    self.commands[name.lower()] = (help, handler, blocking)
+
+  def add_commands(self, table, blocking=()):
+    """ Add each name : (help, handler) of table, those named in blocking as blocking """
+    for name, (help, handler) in table.items():
+      self.add_command(name, help, handler, name in blocking)
+
+  def add_message_handler(self, f):
+    self.message_handlers.append(f)
+
+  def on_connect(self, f):
+    self.connect_handlers.append(f)
+
+  def on_disconnect(self, f):
+    self.disconnect_handlers.append(f)
+
+  def unknown_command(self, word, args):
+    self.sysmsg("ERROR: Command not understood")
+
+  def usage(self, args):
+    self.sysmsg_lines([ "%s understands the following commands:"%self.nick ] +
+                      [ '  ' + name + ' : ' + help for name, (help, handler, blocking) in self.commands.items() ])
+
+  def send_stats(self, args):
+    self.sysmsg("queue %d (at most %d), %d messages sent as %d lines, %d dropped"%(
+      len(self.queue), self.max_depth, self.sent, self.lines_sent, self.dropped))
+    for p, name in [ (CONTROL, 'control'), (REPLY, 'reply'), (CHATTER, 'chatter') ]:
+      count, total, longest = self.latency[p]
+      if count:
+        self.sysmsg("  %s: %d sent, waited %.0f ms on average, %.0f ms at most"%(name, count, 1000*total/count, 1000*longest))
+
+  def invoke(self, handler, args):
+    try:
+      handler(args)
+    except:
+      handle_exception()
+      self.sysmsg("ERROR: that command failed; see the %s console for details"%self.nick)
+
+  def submit(self, f, *args):
+    """ Run f(*args) in the thread pool, reporting any exception """
+    def guarded():
+      try:
+        f(*args)
+      except:
+        handle_exception()
+    return self.executor.submit(guarded)
+
+  def privmsg(self, nick, target, message, **kwargs):
+    if nick == self.nick:
+      return
+    for f in self.message_handlers:
+      try:
+        if f(nick, target, message):
+          return
+      except:
+        handle_exception()
+    if not message.startswith(self.prefix):
+      return
+    elems = message[len(self.prefix):].split()
+    if not elems:
+      return
+    command = self.commands.get(elems[0].lower())
+    if command is None:
+      self.unknown_command(elems[0], ' '.join(elems[1:]))
+      return
+    help, handler, blocking = command
+    if blocking:
+      self.executor.submit(self.invoke, handler, ' '.join(elems[1:]))
+    else:
+      self.invoke(handler, ' '.join(elems[1:]))
+
+  # -- sending
+
+  def send(self, command, priority=REPLY, coalesce=False, **kwargs):
+    """ Send a command to the server (e.g send('PRIVMSG', target=..., message=...)).
+        Safe from any thread. Registration and PING/PONG go straight out;
+        everything else is queued by priority and paced, and held whilst
+        disconnected. """
+    try:
+      in_loop = asyncio.get_running_loop() is self.loop
+    except RuntimeError:
+      in_loop = False
+    if command in unqueued:
+      if in_loop:
+        self.send_now(command, kwargs)
+      else:
+        self.loop.call_soon_threadsafe(self.send_now, command, kwargs)
+      return
+    item = (priority, time.perf_counter(), command, kwargs, coalesce)
+    if in_loop:
+      self.enqueue(item)
+    else:
+      self.loop.call_soon_threadsafe(self.enqueue, item)
+
+  def send_now(self, command, kwargs):
+    if self.client.protocol is None:
+      print("Not connected; dropped %s %s"%(command, kwargs))
+      return
+    self.client.send(command, **kwargs)
+
+  def sysmsg(self, s, priority=REPLY):
+    self.send("PRIVMSG", priority, target=self.channel, message=s)
+
+  def publish(self, command, result=None, value=None, id=None, text=None, **params):
+    """ Publish an event on the bot bus (see bot_bus); safe from any thread """
+    try:
+      self.bus.publish(command, result, value, id, text, **params)
+    except:
+      handle_exception()
+
+  def report(self, text, command, result=None, value=None, id=None, **params):
+    """ Post text to the channel as a control message, and publish it as an event """
+    self.publish(command, result, value, id, text, **params)
+    self.sysmsg(text, CONTROL)
+
+  def sysmsg_lines(self, lines, priority=CHATTER):
+    """ Post several lines, which may be joined into fewer messages """
+    for s in lines:
+      self.send("PRIVMSG", priority, True, target=self.channel, message=s)
+
+  def enqueue(self, item):
+    priority, queued_at, command, kwargs, coalesce = item
+    if len(self.queue) >= self.max_queue:
+      self.dropped += 1
+      print("Send queue full; dropped %s %s"%(command, kwargs))
+      return
+    self.seq += 1
+    heapq.heappush(self.queue, (priority, self.seq, queued_at, command, kwargs, coalesce))
+    self.max_depth = max(self.max_depth, len(self.queue))
+    self.queue_ready.set()
+
+  def take_token(self):
+    """ Seconds to wait before the next message may go, or 0 having used up a token """
+    if not self.send_rate:
+      return 0
+    now = time.perf_counter()
+    self.tokens = min(self.send_burst, self.tokens + (now - self.last_refill)*self.send_rate)
+    self.last_refill = now
+    if self.tokens < 1:
+      return (1 - self.tokens) / self.send_rate
+    self.tokens -= 1
+    return 0
+
+  def next_message(self):
+    """ Pop the most urgent message, joined with any coalescable ones queued after it """
+    priority, seq, queued_at, command, kwargs, coalesce = heapq.heappop(self.queue)
+    waited = [ queued_at ]
+    if coalesce:
+      kwargs = dict(kwargs)
+      while self.queue:
+        p, s, t, c, k, more = self.queue[0]
+        if not (more and p == priority and c == command and k['target'] == kwargs['target']):
+          break
+        message = kwargs['message'] + self.separator + k['message']
+        if len(message) > self.max_message:
+          break
+        heapq.heappop(self.queue)
+        kwargs['message'] = message
+        waited.append(t)
+    return priority, command, kwargs, waited
+
+  async def sender(self):
+    while self.is_running:
+      if not self.queue or not self.registered:
+        self.queue_ready.clear()
+        await self.queue_ready.wait()
+        continue
+      delay = self.take_token()
+      if delay:
+        await asyncio.sleep(delay)
+        continue
+      priority, command, kwargs, waited = self.next_message()
+      self.send_now(command, kwargs)
+      now = time.perf_counter()
+      stats = self.latency[priority]
+      for t in waited:
+        stats[0] += 1
+        stats[1] += now - t
+        stats[2] = max(stats[2], now - t)
+      self.sent += len(waited)
+      self.lines_sent += 1
+
+  # -- connection
+
+  async def heard(self, next_handler, message):
+    self.last_heard = self.loop.time()
+    await next_handler(message)
+
+  def connected(self, **kwargs):
+    print("Connected to IRC server")
+    self.last_heard = self.loop.time()
+    self.send('NICK', nick=self.nick)
+    self.send('USER', user=self.nick, realname=self.realname)
+    self.send('JOIN', channel=self.channel)
+    for f in self.connect_handlers:
+      try:
+        f()
+      except:
+        handle_exception()
+
+  def welcomed(self, **kwargs):
+    self.backoff = self.min_backoff # the server has accepted us, so start afresh
+    self.registered = True
+    self.queue_ready.set()
+
+  def disconnected(self, **kwargs):
+    print("Lost connection to IRC server")
+    self.registered = False
+    for f in self.disconnect_handlers:
+      try:
+        f()
+      except:
+        handle_exception()
+    if self.is_running:
+      self.loop.create_task(self.connect(self.next_backoff()))
+
+  def next_backoff(self):
+    delay = self.backoff
+    self.backoff = min(2*self.backoff, self.max_backoff)
+    return delay
+
+  def keepalive(self, message, **kwargs):
+    self.send('PONG', message=message)
+
+  async def connect(self, delay=0):
+    await asyncio.sleep(delay)
+    while self.is_running:
+      try:
+        await self.client.connect()
+        return
+      except OSError as e:
+        delay = self.next_backoff()
+        print("Could not connect to IRC server (%s); retrying in %g s"%(e, delay))
+        await asyncio.sleep(delay)
+
+  async def watchdog(self):
+    while self.is_running:
+      await asyncio.sleep(self.ping_interval / 4)
+      if self.client.protocol is None:
+        continue
+      silent = self.loop.time() - self.last_heard
+      if silent > self.ping_interval + self.ping_timeout:
+        print("Nothing from IRC server for %d s; reconnecting"%silent)
+        await self.client.disconnect()
+      elif silent > self.ping_interval:
+        self.send('PING', message=self.nick)
+
+  def start(self):
+    self.loop.create_task(self.connect())
+    self.loop.create_task(self.watchdog())
+    self.loop.create_task(self.sender())
+
+  def run(self):
+    """ Connect, then run the event loop forever """
+    self.start()
+    self.loop.run_forever()
+
+  def stop(self):
+    self.is_running = False
+    self.queue_ready.set()
+    if self.client.protocol is not None:
+      self.loop.create_task(self.client.disconnect())
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# Write-time and file-size benchmark for picoscope HDF5 codecs.
+#
+# Usage:  python hdf5_bench.py [SAMPLES_PER_CHANNEL] [OUTPUT_DIR]
+#
+# Four synthetic int16 channels (noise plus a decaying pulse, like a shot)
+# of 25M samples each are written once per codec, plus the original
+# float64 + default gzip layout for comparison.
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import h5py
+import picointerface
+
+def synthetic_channels(n, seed=1):
+  rng = np.random.default_rng(seed)
+  t = np.arange(n, dtype=np.float64)
+  channels = []
+  for i in range(4):
+    pulse = 8000 * np.exp(-np.maximum(t - n/4, 0) / (n/50)) * (t > n/4)
+    noise = rng.normal(0, 200, n)
+    channels.append((pulse * np.sin(t / (200 + 50*i)) + noise).astype(np.int16))
+  return channels
+
+def timed(f):
+  t0 = time.perf_counter()
+  f()
+  return time.perf_counter() - t0
+
+def main():
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 25000000
+  outdir = sys.argv[2] if len(sys.argv) > 2 else tempfile.mkdtemp()
+  os.makedirs(outdir, exist_ok=True)
+  names = [ 'Channel_A', 'Channel_B', 'Channel_C', 'Channel_D' ]
+  attrs = [ { 'scale' : 1/32512., 'offset' : 0.0, 'sampling_interval' : 4e-9 } ]*4
+  print("Generating 4 channels of %d samples"%n)
+  data = synthetic_channels(n)
+  raw_mb = 4 * n * 2 / 1e6
+
+  def original():
+    h5f = h5py.File(path, 'w')
+    for name, d, a in zip(names, data, attrs):
+      h5f.create_dataset(name, data = d * a['scale'], compression='gzip')
+    h5f.close()
+
+  results = []
+  path = os.path.join(outdir, 'original.h5')
+  results.append(('float64 + gzip (original)', timed(original), os.path.getsize(path)))
+  for codec in picointerface.codecs:
+    try:
+      picointerface.filterOptions(codec)
+    except ValueError as e:
+      print("  skipping %s: %s"%(codec, e))
+      continue
+    path = os.path.join(outdir, codec + '.h5')
+    def write():
+      h5f = h5py.File(path, 'w')
+      picointerface.writeChannels(h5f, names, data, attrs, codec)
+      h5f.close()
+    results.append(('int16 + ' + codec, timed(write), os.path.getsize(path)))
+    # check the round trip
+    h5f = h5py.File(path, 'r')
+    for name, d in zip(names, data):
+      assert np.array_equal(h5f[name][:], d), "%s: data mismatch in %s"%(codec, name)
+    h5f.close()
+
+  print("%-28s %10s %12s %10s"%('layout', 'write (s)', 'size (MB)', 'MB/s in'))
+  for label, dt, size in results:
+    print("%-28s %10.2f %12.1f %10.0f"%(label, dt, size/1e6, raw_mb/dt))
+
+if __name__ == '__main__':
+  main()
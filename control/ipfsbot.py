@@ -1,9 +1,8 @@
-import bottom
+import bot_runtime
 import ipfsApi
 import time
 import sys
 import traceback
-import asyncio
 
 host = '192.168.137.3'
 port = 6667
@@ -35,15 +34,8 @@ while(not connected):
     time.sleep(5)
 
 print("Creating IRC client")
-bot = bottom.Client(host=host, port=port, ssl=ssl)
-
-def sysmsg(s):
-  bot.send("PRIVMSG", target=CHANNEL, message=s)
-
-def usage(message):
-  sysmsg("%s understands the following commands:"%NICK)
-  for k,v in commands.items():
-    sysmsg('  ' + k + ' : ' + v[0])
+bot = bot_runtime.BotRuntime(NICK, 'stepper control IRC bot', CHANNEL, host, port, ssl)
+sysmsg = bot.sysmsg
 
 def publish(path):
   try:
@@ -60,43 +52,8 @@ def publish(path):
 
 commands = {
     'publish' :      ( 'publish <PATH> publishes the given file or directory to IPFS', publish),
-    'help' : ( 'shows this useful message', usage),
 }
-
-@bot.on('CLIENT_CONNECT')
-def connect(**kwargs):
-    print("Connected")
-    bot.send('NICK', nick=NICK)
-    bot.send('USER', user=NICK,
-             realname='stepper control IRC bot')
-    bot.send('JOIN', channel=CHANNEL)
-
-@bot.on("client_disconnect")
-async def reconnect(**kwargs):
-    await asyncio.sleep(3, loop=bot.loop)
-    bot.loop.create_task(bot.connect())
-
-@bot.on('PING')
-def keepalive(message, **kwargs):
-    bot.send('PONG', message=message)
-
-@bot.on('PRIVMSG')
-def message(nick, target, message, **kwargs):
-    # Don't echo ourselves
-    if nick == NICK:
-        return
-    # Only respond to commands that are to us.
-    if not message.startswith(NICK + ': '):
-      return
-
-    stripped = ''.join(message.split(NICK+': ')[1:]).strip()
-
-    elems = stripped.split()
-    if elems[0] in commands.keys():
-      commands[elems[0]][1]( ' '.join(elems[1:]))
-    else:
-      sysmsg("ERROR: Command not understood")
+bot.add_commands(commands, blocking=[ 'publish' ])
 
 print("Starting ipfs bot")
-bot.loop.create_task(bot.connect())
-bot.loop.run_forever()
\ No newline at end of file
+bot.run()
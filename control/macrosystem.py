@@ -4,10 +4,14 @@ import re
 import copy
 import traceback
 import time
+import threading
+import collections
+import functools
 
 
 handlers = dict()
 handlers['emit'] = print
+handlers['emit_lines'] = lambda lines: [ print(s) for s in lines ] # for listings, which may be coalesced
 
 class AbortError(Exception):
   pass
@@ -17,9 +21,8 @@ class TimeOutError(Exception):
     self.value = value
 
 def sleep(secs):  # sleep, or bail out if received an abort message
-  while(secs > 0 and not state.should_abort):
-    time.sleep(0.1)
-    secs = secs - 0.1
+  with state.cond:
+    state.cond.wait_for(lambda: state.should_abort, timeout=secs)
   if state.should_abort:
     state.should_abort = False
     raise AbortError()
@@ -31,46 +34,216 @@ def handle_exception():
 class State:
   pass
 
+# A pre-parsed call, queued in place of source text: function(*args)
+Command = collections.namedtuple('Command', ['function', 'args'])
+
+class Backlog:
+  """ Recent channel messages, bounded in number and age, indexed by first word
+      so that prefix lookups only examine messages that could match """
+
+  def __init__(self, maxlen=1000, max_age=300):
+    self.maxlen = maxlen     # messages kept at most
+    self.max_age = max_age   # seconds a message is kept
+    self.entries = collections.deque()  # (arrival time, key, message), oldest first
+    self.index = dict()                 # key -> deque of messages with that key, oldest first
+
+  def key(self, s):
+    return s.split(None, 1)[0] if s.strip() else ''
+
+  def __len__(self):
+    return len(self.entries)
+
+  def evict_oldest(self):
+    t, k, m = self.entries.popleft()
+    same_key = self.index[k]
+    same_key.popleft()
+    if not same_key:
+      del self.index[k]
+
+  def expire(self):
+    cutoff = time.monotonic() - self.max_age
+    while self.entries and self.entries[0][0] < cutoff:
+      self.evict_oldest()
+
+  def append(self, s):
+    k = self.key(s)
+    self.entries.append((time.monotonic(), k, s))
+    self.index.setdefault(k, collections.deque()).append(s)
+    if len(self.entries) > self.maxlen:
+      self.evict_oldest()
+
+  def find(self, prefix):
+    """ does any remembered message start with prefix? """
+    self.expire()
+    k = self.key(prefix)
+    if k != prefix.lstrip() and prefix.lstrip()[len(k):][:1].isspace():
+      # the prefix contains a whole first word, so only that bucket can match
+      candidates = [ self.index.get(k, ()) ]
+    else:
+      # the prefix ends part way through the first word
+      candidates = [ v for key, v in self.index.items() if key.startswith(k) ]
+    for messages in candidates:
+      for m in messages:
+        if m.startswith(prefix):
+          return True
+    return False
+
+  def clear(self):
+    self.entries.clear()
+    self.index.clear()
+
 def abort():
-  state.should_abort = True
-  state.waiting = False
+  with state.cond:
+    state.should_abort = True
+    state.waiting = False
+    state.cond.notify_all()
 
 def emit(s):
   if state.should_abort:
     raise AbortError()
   else:
+    forget_events(s)
     handlers['emit'](s)
 
+def forget_events(s):
+  """ drop the bus events from the device s is addressed to ('device: ...'), so
+      that a later wait_for() cannot take one left over from an earlier command """
+  if ':' not in s:
+    return
+  device = s.split(':', 1)[0].strip()
+  with state.cond:
+    kept = [ e for e in state.events if e['device'] != device ]
+    state.events.clear()
+    state.events.extend(kept)
+
 def showhelp():
-  emit("New commands can be defined using the following_syntax:")
-  emit("  def my_function(argument) -> dosomething(argument); dosomethingelse()")
-  emit("Existing commands: ")
-  for k,v in sorted(state.functions.items()):
-    emit("   %s  ->  %s"%(k, v))
+  if state.should_abort:
+    raise AbortError()
+  handlers['emit_lines']([
+    "New commands can be defined using the following_syntax:",
+    "  def my_function(argument) -> dosomething(argument); dosomethingelse()",
+    "Existing commands: " ] +
+    [ "   %s  ->  %s"%(k, v) for k,v in sorted(state.functions.items()) ])
 
 def wait(s, timeout=1):
-  state.waiting_for = s
-  state.waiting = True
+  with state.cond:
+    state.waiting_for = s
+    state.waiting = True
 
-  for p in state.backlog:
-    if p.startswith(s):
+    if state.backlog.find(s):
       state.waiting = False
-      state.backlog = []
-  
-  while timeout > 0 and not state.should_abort and state.waiting:
-    time.sleep(0.2)
-    timeout = timeout - 0.2
+      state.backlog.clear()
+
+    state.cond.wait_for(lambda: state.should_abort or not state.waiting, timeout=timeout)
 
   if state.should_abort:
     raise AbortError()
     return
 
   if state.waiting:
+    state.waiting = False
     raise TimeOutError(s)
     return
 
   return
 
+def hear(s):
+  """ note a channel message that is not a command for us, waking wait() or
+      await_replies() the moment it satisfies them """
+  with state.cond:
+    note_reply(s)
+    if state.waiting:
+      if s.startswith(state.waiting_for):
+        state.waiting = False
+    else:
+      state.backlog.append(s)
+    state.cond.notify_all()
+
+def hear_event(event):
+  """ note an event from the bot bus (see bot_bus), waking wait_for(); its
+      text is heard as if it had come over IRC """
+  with state.cond:
+    state.events.append(event)
+    state.cond.notify_all()
+  if event.get('text'):
+    hear(event['text'])
+
+def wait_for(device, command, result='OK', value=None, text=None, timeout=1):
+  """ wait for an event from device about command on the bot bus, and return it;
+      panics if it does not come, and aborts if its result is not the one given.
+      Given a value, events for command with other values are passed over (the
+      bank reports value 1 when a charge starts, and 0 when it is done). Given
+      text, hearing it over IRC will do instead, and None is returned: the bus
+      is optional, and without it (or its forwarder) no events arrive. """
+  def find():
+    for i, e in enumerate(state.events):
+      if e['device'] == device and e['command'] == command:
+        if value is None or e['value'] == value or (result is not None and e['result'] != result):
+          return i
+    return None
+  def heard():
+    return text is not None and not state.waiting
+  with state.cond:
+    if text is not None:
+      state.waiting_for = text
+      state.waiting = True
+      if state.backlog.find(text):
+        state.waiting = False
+        state.backlog.clear()
+    state.cond.wait_for(lambda: state.should_abort or heard() or find() is not None, timeout=timeout)
+    i = find()
+    event = None
+    if i is not None:
+      for j in range(i + 1): # it, and everything heard before it
+        event = state.events.popleft()
+    was_heard = heard()
+    state.waiting = False
+
+  if state.should_abort:
+    raise AbortError()
+  if event is None:
+    if was_heard:
+      return None
+    raise TimeOutError("%s %s"%(device, command))
+  if result is not None and event['result'] != result:
+    emit("ERROR: %s %s gave %s"%(device, command, event['result']))
+    raise AbortError()
+  return event
+
+def request(s):
+  """ emit a device command tagged with a fresh request id, and return the id """
+  with state.cond:
+    state.request_id = state.request_id % 9999 + 1
+    rid = state.request_id
+    state.replies[rid] = None
+  emit("%s #%d"%(s, rid))
+  return rid
+
+def note_reply(s):
+  """ record s if it is the reply to an outstanding request """
+  m = re.search(r'\s#(\d+)$', s)
+  if m:
+    rid = int(m.group(1))
+    if rid in state.replies and state.replies[rid] is None:
+      state.replies[rid] = s[:m.start()]
+
+def await_replies(ids, timeout=1):
+  """ wait until every request in ids has been answered; returns the replies in order """
+  with state.cond:
+    state.cond.wait_for(lambda: state.should_abort or all(state.replies.get(rid) is not None for rid in ids),
+                        timeout=timeout)
+
+  if state.should_abort:
+    raise AbortError()
+
+  replies = [ state.replies.pop(rid, None) for rid in ids ]
+  if None in replies:
+    raise TimeOutError("replies to requests %s"%', '.join('#%d'%rid for rid in ids))
+  for r in replies:
+    if 'ERROR' in r:
+      raise AbortError()
+  return replies
+
 state = State()
 state.locals = locals()
 state.globals = globals()
@@ -78,35 +251,53 @@ state.should_abort = False
 state.waiting = False
 state.seq = 1
 state.parent = None
+state.request_id = 0
+state.backlog = Backlog()
+state.cond = threading.Condition()  # guards waiting/should_abort/backlog/replies; notified on change
+state.replies = dict()  # request id -> reply, or None whilst outstanding
+state.events = collections.deque(maxlen=100)  # bot bus events not yet claimed by wait_for
 
 state.functions = {
   'help()' : 'Primitive: shows this useful help',
   'emit(s)' : 'Primitive: sends the string s to the IRC channel',
   'wait(s, timeout=1)' : 'Primitive: waits to hear the string s from the IRC channel, or panics after timeout seconds',
+  'request(s)' : "Primitive: like emit, but tags s with a request id (e.g 'bank: get hv_voltage #12') and returns the id",
+  'await_replies(ids, timeout=1)' : 'Primitive: waits for the replies to all the given request ids, or panics after timeout seconds',
+  'wait_for(device, command, result="OK", value=None, text=None, timeout=1)' : "Primitive: waits for device's result (and value, if given) for command on the bot bus, or for text over IRC if given (e.g wait_for('bank', 'charge', value=0, text='charge : OK, value = 0', timeout=30)), or panics after timeout seconds",
   'process_line(s)' : "Primitive: lines starting with '@' are executed; lines starting with '!' are emitted;  lines starting with '#' are ignored"
 }
 
 inputs = [
   'RUNDIR = r"c:\data\default_rundir"',
-  'def setup_rigols() -> emit("rigol: add_device 192.168.137.10 rigol_1"); wait("Connected to rigol", 5)',
+  'def setup_rigols() -> emit("rigol: add_device 192.168.137.10 rigol_1"); wait_for("rigol", "connect", text="Connected to rigol", timeout=5)',
   'def charge_enable(s) -> emit("bank: set charge_enable " + s)',
   'def charge_power(s) -> emit("bank: set charge_power " +s)',
-  'def countdown(n) -> [ (emit("say: "+str(d)), wait("OK", 5)) for d in range(n,0,-1) ]',
+  'def countdown(n) -> [ (emit("say: "+str(d)), wait_for("say", "say", text="OK", timeout=5)) for d in range(n,0,-1) ]',
   'def setup() -> setup_rigols(); countdown(5); charge_power("on"); sleep(0.5); charge_enable("on")',
   'def shutdown() -> charge_power("off"); sleep(0.1); charge_enable("off"); emit("Shutdown complete")',
-  'def charge(V) -> emit("bank: charge "+str(V)); wait("charge : OK, value = 0", 30)',
+  'def charge(V) -> emit("bank: charge "+str(V)); wait_for("bank", "charge", value=0, text="charge : OK, value = 0", timeout=30)',
   'def start_capture() -> emit("picoscope: start_capture 5000")',
-  'def pulse() -> emit("bank: pulse"); wait("pulse : OK, value = 0", 10)',
+  'def pulse() -> emit("bank: pulse"); wait_for("bank", "pulse", value=0, text="pulse : OK, value = 0", timeout=10)',
   'def collect_data(dir) -> emit("picoscope: write_data " + dir); emit("rigol: write_data " + dir)',
   'def shot(V, dir) -> charge(V); start_capture(); pulse(); sleep(1); collect_data(dir); sleep(10)',
   'def run_file(filename) -> state.seq = 1; [  process_line(line.strip()) for line in open(filename).readlines() ]'
 ]
 
 def feed_to_self(s):
-   state.parent.consume( state.nick + ': ' + s )
+  # queue macro source text or a Command to run after the current one,
+  # without a round trip through the IRC input path
+  state.parent.enqueue(s)
 
 def deferred_emit(s):
-  feed_to_self( 'emit("%s")'%s )
+  feed_to_self(Command(emit, (s,)))
+
+def request_and_await(s, timeout=1):
+  return await_replies([ request(s) ], timeout)
+
+def run_shot(V, seq):
+  # looked up when the shot runs, so that redefinitions take effect
+  g = state.globals
+  g['shot'](V, os.path.join(g['RUNDIR'], "{:03}".format(seq)))
 
 def process_line(s):
   if state.should_abort:
@@ -117,7 +308,7 @@ def process_line(s):
   elif s.startswith("@"):
     feed_to_self( s[1:].strip() )
   elif s.startswith("!"):
-    feed_to_self( 'emit("%s")'%s[1:].strip() )
+    deferred_emit( s[1:].strip() )
   elif s.strip() == '':
     return
   else:
@@ -141,23 +332,13 @@ def process_line(s):
       elif elems_as_numbers[0] < 0:
         deferred_emit("stepper: backwards %s"%elems[0])
       if elems_as_numbers[1] > 0:
-        feed_to_self('sleep(%d)'%elems_as_numbers[1])
-      # set the parameters
-      for i in [1,2,3,4]:
-        deferred_emit("bank: set pulse_delay %d %d"%(i, elems_as_numbers[4]))
-        feed_to_self("wait('set pulse_delay: OK')" )
-        deferred_emit("bank: set pulse_width %d %d"%(i, elems_as_numbers[5]))
-        feed_to_self("wait('set pulse_width: OK')" )
-
-      deferred_emit("bank: set pulse_delay 5 %d"%elems_as_numbers[6])
-      feed_to_self("wait('set pulse_delay: OK')" )
-
-      deferred_emit("bank: set pulse_width 5 %d"%elems_as_numbers[7])
-      feed_to_self("wait('set pulse_width: OK')" )
+        feed_to_self(Command(sleep, (elems_as_numbers[1],)))
+      # set the pulse delay and width for all five banks in a single frame
+      timings = [ elems_as_numbers[4], elems_as_numbers[5] ]*4 + [ elems_as_numbers[6], elems_as_numbers[7] ]
+      feed_to_self(Command(request_and_await, ("bank: set_timings %s"%' '.join(str(t) for t in timings), 5)))
 
       # fire the shot and collect the data
-      shot_cmd = 'shot(%d, os.path.join(RUNDIR, str("{:03}".format(state.seq))))'%(elems_as_numbers[2])
-      feed_to_self(shot_cmd)
+      feed_to_self(Command(run_shot, (elems_as_numbers[2], state.seq)))
       state.seq = state.seq + 1
 
     except:
@@ -179,11 +360,21 @@ def register_function(s):
     name = s.split(':')[0][3:].strip()
     state.functions[name] = ';'.join(s.split('\n')[1:])
 
+@functools.lru_cache(maxsize=512)
+def compile_source(s):
+  """ demangle and compile s once, however often it is invoked """
+  source = demangle(s)
+  return compile(source, '<macro>', 'exec'), source
+
 def guarded_invoke(s,g,l):
   try:
-    exec(demangle(s),g,l)
+    if isinstance(s, Command):
+      s.function(*s.args)
+      return
+    code, source = compile_source(s)
+    exec(code,g,l)
     if (s.startswith('def')):
-      register_function(demangle(s))
+      register_function(source)
   except AbortError as e:
     state.should_abort = False
     state.waiting = False
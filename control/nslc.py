@@ -5,12 +5,12 @@ import time
 import serial
 import numpy as np
 import sys
-import zmq
 import traceback
 
 class NSLC:
 
-    candidate_frame = b''
+    candidate_frame = None  # bytes received since the last frame terminator
+    search_from = 0         # offset in candidate_frame not yet scanned for LF
     frame_handlers = []
     error_handlers = []
 
@@ -30,6 +30,14 @@ class NSLC:
     ,127,54,90,179,102,19,214,5,37,97,126,200,27,65,154,21,252,166
     ,71,22,151,77,9,251,117,188,56,197,8,139,210,249,239,246,254,255
     ,242,87,60,18])
+    T_bytes = bytes(T.astype(np.uint8))  # same table, for fast scalar lookups
+    T_uint8 = T.astype(np.uint8)         # same table, for vectorized lookups
+
+    def __init__(self):
+      self.candidate_frame = bytearray()
+      self.search_from = 0
+      self.frame_handlers = []
+      self.error_handlers = []
 
     def handle_exception(self):
       print("Unexpected error:", sys.exc_info()[0:2])
@@ -41,84 +49,161 @@ class NSLC:
     def add_frame_handler(self, f):
       self.frame_handlers.append(f)
 
-    def call_frame_handlers(self):
+    def call_frame_handlers(self, payload):
       for f in self.frame_handlers:
         try:
-          f(self.unframe(self.candidate_frame))
+          f(payload)
         except: 
           print("Error in frame handler : %s "%sys.exc_info()[0])
           self.handle_exception()
 
-    def call_error_handlers(self):
+    def call_error_handlers(self, frame):
       for f in self.error_handlers:
         try:
-          f(self.unframe(self.candidate_frame))
+          f(frame)
         except: 
           print("Error in error handler : %s "%sys.exc_info()[0])
           self.handle_exception()
 
     def pearson_hash(self, input_bytes):
+      T = self.T_bytes
       h = 0
       for byte in input_bytes:
-        index = h ^ byte
-        h = self.T[index]
+        h = T[h ^ byte]
       return bytes([h])
 
+    def pearson_hash_many(self, inputs):
+      """ Hash a list of bytestrings at once; returns a uint8 array of hashes.
+          The loop runs once per byte of the longest input, not once per byte overall. """
+      n = len(inputs)
+      hashes = np.zeros(n, dtype=np.uint8)
+      if n == 0:
+        return hashes
+      lengths = np.fromiter((len(b) for b in inputs), dtype=np.intp, count=n)
+      order = np.argsort(-lengths, kind='stable')  # longest first, so active rows are a prefix
+      lengths = lengths[order]
+      width = int(lengths[0])
+      grid = np.zeros((n, width), dtype=np.uint8)
+      grid[np.arange(width) < lengths[:,None]] = np.frombuffer(b''.join(inputs[i] for i in order), dtype=np.uint8)
+      active = np.searchsorted(-lengths, -np.arange(width), side='left') # rows longer than each column
+      h = np.zeros(n, dtype=np.uint8)
+      for col in range(width):
+        k = active[col]
+        h[:k] = self.T_uint8[h[:k] ^ grid[:k,col]]
+      hashes[order] = h
+      return hashes
+
     def escape(self, bytestring):
-      out = bytes([])
-      for b in bytestring:
-        if b == 10:
-          out += bytes([9,10])
-        elif b == 9:
-          out += bytes([9,32])
-        else:
-          out += bytes([b])
-      return out
+      # TAB must be escaped first, or we would re-escape the TABs introduced for LF
+      return bytes(bytestring).replace(b'\t', b'\t ').replace(b'\n', b'\t\n')
 
     def unescape(self, bytestring):
-      out = bytes([])
-      esc_set = False
-      for b in bytestring:
-        if esc_set:
-          esc_set = False
-          if b == 10:
-            out += bytes([b])
-          elif b == 32:
-            out += bytes([9])
-        elif b == 9:
-          esc_set = True;
-        else:
-          out += bytes([b])
-      return out
+      # Copy the runs between escape characters into a preallocated buffer;
+      # the output can never be longer than the input.
+      data = bytes(bytestring)
+      src = memoryview(data)
+      n_in = len(src)
+      out = bytearray(n_in)
+      n = 0
+      i = 0
+      while i < n_in:
+        j = data.find(9, i)
+        if j < 0:
+          j = n_in
+        out[n:n+j-i] = src[i:j]
+        n += j-i
+        if j+1 < n_in:
+          if src[j+1] == 10:
+            out[n] = 10
+            n += 1
+          elif src[j+1] == 32:
+            out[n] = 9
+            n += 1
+        i = j+2
+      return bytes(out[:n])
 
     def frame(self, bytestring):
       return self.escape( bytestring + self.pearson_hash(bytestring) ) + bytes([10])
 
-    def is_valid_frame(self, bytestring):
+    def decode(self, bytestring):
+      """ Return the payload of a complete frame (terminating LF included), or None if invalid """
       if len(bytestring) < 2:
-        return False
+        return None
       if ( bytestring[-1] != 10): # Valid frames end with LF
-        return False
+        return None
       u = self.unescape(bytestring[:-1]) # drop the LF, then unescape
-      return self.pearson_hash(u[:-1]) == bytes([u[-1]]) # does the checksum match?
+      if len(u) < 1:
+        return None
+      if self.pearson_hash(u[:-1])[0] != u[-1]: # does the checksum match?
+        return None
+      return u[:-1]
+
+    def frame_many(self, bytestrings):
+      """ Frame a list of payloads, hashing them all in one pass """
+      bytestrings = [bytes(b) for b in bytestrings]
+      hashes = self.pearson_hash_many(bytestrings)
+      return [ self.escape(b + bytes([h])) + bytes([10]) for b,h in zip(bytestrings, hashes.tolist()) ]
+
+    def decode_many(self, bytestrings):
+      """ Like decode, for a list of frames; invalid frames decode to None """
+      bodies = []
+      for b in bytestrings:
+        if len(b) < 2 or b[-1] != 10:
+          bodies.append(None)
+        elif 9 in b:
+          bodies.append(self.unescape(b[:-1]) or None)
+        else:
+          bodies.append(bytes(b[:-1]))
+      candidates = [ u for u in bodies if u is not None ]
+      hashes = self.pearson_hash_many([ u[:-1] for u in candidates ]).tolist()
+      out = []
+      k = 0
+      for u in bodies:
+        if u is None:
+          out.append(None)
+        else:
+          out.append(u[:-1] if hashes[k] == u[-1] else None)
+          k += 1
+      return out
+
+    def unframe_many(self, bytestrings):
+      """ Like unframe, for a list of frames; invalid frames are returned unchanged """
+      return [ b if u is None else u for b,u in zip(bytestrings, self.decode_many(bytestrings)) ]
+
+    def is_valid_frame(self, bytestring):
+      return self.decode(bytestring) is not None
 
     def unframe(self, bytestring):
-      if self.is_valid_frame(bytestring):
-        u = self.unescape(bytestring[:-1])
-        return u[:-1]
-      else:
+      u = self.decode(bytestring)
+      if u is None:
         return bytestring
+      return u
 
     def consume(self, bytestring):
-      for b in bytestring:
-        self.candidate_frame += bytes([b])
-        if len(self.candidate_frame) > 2:
-          if self.candidate_frame[-1] == 10 and self.candidate_frame[-2] != 9:
-            if self.is_valid_frame(self.candidate_frame):
-              self.call_frame_handlers()
-            else:
-              self.call_error_handlers()
-            self.candidate_frame = b''
+      """ Feed an arbitrarily sized chunk of received bytes to the decoder """
+      buf = self.candidate_frame
+      buf += bytestring
+      start = 0     # start of the frame currently being assembled
+      search = self.search_from
+      while True:
+        end = buf.find(10, search)
+        if end < 0:
+          break
+        # a frame needs at least one data byte and a hash, and an LF preceded
+        # by TAB is escaped data rather than a terminator
+        if end - start < 2 or buf[end-1] == 9:
+          search = end + 1
+          continue
+        frame = bytes(buf[start:end+1])
+        payload = self.decode(frame)
+        if payload is not None:
+          self.call_frame_handlers(payload)
+        else:
+          self.call_error_handlers(frame)
+        start = end + 1
+        search = start
+      del buf[:start]
+      self.search_from = len(buf)
 
 
 def go():
@@ -134,9 +219,7 @@ def go():
   lc.add_error_handler(errhandler)
 
   while(True):
-    if(s.in_waiting > 0):
-      b = s.read()
-      lc.consume(b)
+    lc.consume(s.read(s.in_waiting or 1))
 
 if __name__ == '__main__':
   go()
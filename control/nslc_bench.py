@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# Throughput benchmark for the NSLC decoder.
+#
+# Usage:  python nslc_bench.py [FRAME_DUMP]
+#
+# FRAME_DUMP is a raw capture of bytes received from the bank (e.g. written
+# with 'cat COM3 > dump.bin'). Without one, a synthetic dump of heartbeats,
+# command responses and bank_voltage replies is generated instead.
+
+import sys
+import time
+import random
+import nslc
+
+class ReferenceNSLC(nslc.NSLC):
+  """ The original byte-at-a-time decoder, kept for comparison """
+
+  def __init__(self):
+    super().__init__()
+    self.candidate_frame = b''
+
+  def pearson_hash(self, input_bytes):
+    h = 0
+    for byte in input_bytes:
+      index = h ^ byte
+      h = self.T[index]
+    return bytes([h])
+
+  def escape(self, bytestring):
+    out = bytes([])
+    for b in bytestring:
+      if b == 10:
+        out += bytes([9,10])
+      elif b == 9:
+        out += bytes([9,32])
+      else:
+        out += bytes([b])
+    return out
+
+  def unescape(self, bytestring):
+    out = bytes([])
+    esc_set = False
+    for b in bytestring:
+      if esc_set:
+        esc_set = False
+        if b == 10:
+          out += bytes([b])
+        elif b == 32:
+          out += bytes([9])
+      elif b == 9:
+        esc_set = True;
+      else:
+        out += bytes([b])
+    return out
+
+  def is_valid_frame(self, bytestring):
+    if len(bytestring) < 2:
+      return False
+    if ( bytestring[-1] != 10):
+      return False
+    u = self.unescape(bytestring[:-1])
+    return self.pearson_hash(u[:-1]) == bytes([u[-1]])
+
+  def unframe(self, bytestring):
+    if self.is_valid_frame(bytestring):
+      u = self.unescape(bytestring[:-1])
+      return u[:-1]
+    else:
+      return bytestring
+
+  def consume(self, bytestring):
+    for b in bytestring:
+      self.candidate_frame += bytes([b])
+      if len(self.candidate_frame) > 2:
+        if self.candidate_frame[-1] == 10 and self.candidate_frame[-2] != 9:
+          if self.is_valid_frame(self.candidate_frame):
+            for f in self.frame_handlers:
+              f(self.unframe(self.candidate_frame))
+          else:
+            for f in self.error_handlers:
+              f(self.unframe(self.candidate_frame))
+          self.candidate_frame = b''
+
+
+def synthetic_dump(n_frames=20000, seed=1):
+  rng = random.Random(seed)
+  lc = nslc.NSLC()
+  out = bytearray()
+  for i in range(n_frames):
+    r = rng.random()
+    if r < 0.5:
+      payload = b'U'
+    elif r < 0.9:
+      payload = bytes([rng.choice([0,1,8,16]), rng.choice([0,1,2,4,70]), 0, rng.randrange(256), rng.randrange(256)])
+    else:
+      payload = bytes([0, 32]) + bytes(rng.randrange(256) for _ in range(16))
+    out += lc.frame(payload)
+  return bytes(out)
+
+def run(decoder, dump, chunk_size):
+  frames = []
+  errors = []
+  decoder.add_frame_handler(frames.append)
+  decoder.add_error_handler(errors.append)
+  t0 = time.perf_counter()
+  for i in range(0, len(dump), chunk_size):
+    decoder.consume(dump[i:i+chunk_size])
+  dt = time.perf_counter() - t0
+  return dt, frames, errors
+
+def main():
+  if len(sys.argv) > 1:
+    dump = open(sys.argv[1], 'rb').read()
+  else:
+    dump = synthetic_dump()
+  print("Decoding %d bytes"%len(dump))
+
+  ref_time, ref_frames, ref_errors = run(ReferenceNSLC(), dump, 1)
+  print("  reference (1 byte reads)  : %10.0f bytes/sec"%(len(dump)/ref_time))
+  for chunk_size in [1, 64, 4096]:
+    dt, frames, errors = run(nslc.NSLC(), dump, chunk_size)
+    assert frames == ref_frames and errors == ref_errors, "decoders disagree"
+    print("  streaming (%4d byte reads): %10.0f bytes/sec  (%.1fx)"%(chunk_size, len(dump)/dt, ref_time/dt))
+
+  # bulk validation of already-split frames, e.g. from a log
+  lc = nslc.NSLC()
+  frames = [ f + b'\n' for f in dump.split(b'\n')[:-1] ]
+  t0 = time.perf_counter()
+  single = [ lc.unframe(f) for f in frames ]
+  t_single = time.perf_counter() - t0
+  t0 = time.perf_counter()
+  batch = lc.unframe_many(frames)
+  t_batch = time.perf_counter() - t0
+  assert single == batch, "batch and scalar unframe disagree"
+  print("  unframe      (%d frames)  : %10.0f frames/sec"%(len(frames), len(frames)/t_single))
+  print("  unframe_many (%d frames)  : %10.0f frames/sec  (%.1fx)"%(len(frames), len(frames)/t_batch, t_single/t_batch))
+
+if __name__ == '__main__':
+  main()
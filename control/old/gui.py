@@ -9,13 +9,15 @@ import win32com.client
 import time
 import os
 import io
-import csv
 import picoscope
 from picoscope import ps3000a
 
 
 import Pmw
 import system_control
+import rigol_data
+
+export_csv = False # also write each scope's data as CSV after every step
 
 bank = system_control.BankControl()
 stepper = system_control.StepperControl()
@@ -603,22 +605,11 @@ def run_step(step, n):
   print(data.keys())
   seq = '{0:03d}'.format(n)
   outdir = os.path.join(output_dir.get(), seq)
-  if not os.path.exists(outdir):
-    os.makedirs(outdir)
-  for scope in data.keys():
-    print("Writing data for scope %s"%scope)
-    this_scope_data = data[scope]
-    outfile = os.path.join(outdir, "%s.csv"%scope)
-    with open(outfile,"w") as csvfile:
-      writer =  csv.writer(csvfile)
-      # get length of time series
-      length = len(data[scope]['Channel_1'][0])
-      for i in range(length):
-        line = []
-        line.append(data[scope]['Channel_1'][1][i])
-        for channel in sorted(this_scope_data.keys()):
-          line.append(data[scope][channel][0][i])
-        writer.writerow(line)
+  print("Writing data for scopes %s"%', '.join(sorted(data.keys())))
+  rigol_data.writeShot(os.path.join(outdir, 'rigol'), data)
+  if export_csv:
+    for scope in data.keys():
+      rigol_data.writeCSV(os.path.join(outdir, "%s.csv"%scope), data[scope], header=False)
 
   if n==len(sequence):
     reset_step_indicators()
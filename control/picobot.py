@@ -1,10 +1,10 @@
-import bottom
+import bot_runtime
 import picointerface
-import asyncio
 import numpy
 import time
 import traceback
 import sys
+import concurrent.futures
 
 host = '192.168.137.3'
 port = 6667
@@ -14,7 +14,7 @@ NICK = "picoscope"
 CHANNEL = "#system"
 
 
-bot = bottom.Client(host=host, port=port, ssl=ssl)
+bot = bot_runtime.BotRuntime(NICK, 'iamthetalkingrobot', CHANNEL, host, port, ssl)
 
 def handle_exception():
   print("Unexpected error:", sys.exc_info()[0:2])
@@ -27,29 +27,232 @@ class State:
 
 state = State()
 state.p = picointerface.PicoScope()
+# every attached scope (including state.p), for multi-device shots
+state.scopes = picointerface.PicoScopeManager([ state.p ])
+state.current = None  # the shot being armed or captured
+state.last = None     # the most recent shot with data
+# two workers, so a shot can be written whilst the next one is captured
+state.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
 
-def sysmsg(s):
-  bot.send("PRIVMSG", target=CHANNEL, message=s)
+sysmsg = bot.sysmsg
 
-def start_capture(message):
+class Job:
+  """ One shot, from arming the scope until its data is on disk.
+      States go armed -> capturing -> captured -> writing -> done (or failed). """
+  count = 0
+
+  def __init__(self, device):
+    Job.count += 1
+    self.number = Job.count
+    self.device = device # the PicoScope or PicoScopeManager taking the shot
+    self.state = None
+    self.buffer = None  # capture buffer index held by this shot
+    self.data = None
+    self.attrs = None
+    self.summaries = None
+    self.path = None    # where to write it; set by write_data, perhaps before it is captured
+
+def format_range(x, fmt):
+  """ One value, or the spread of values over the segments of a burst """
+  x = numpy.ravel(x)
+  if len(x) == 1:
+    return fmt%x[0]
+  return (fmt + '..' + fmt)%(x.min(), x.max())
+
+def format_summary(summaries, names=None):
+  """ One line of per-channel statistics, e.g for the channel after each shot """
+  parts = []
+  for name, s in zip(names or state.p.names, summaries):
+    parts.append("%s rms %sV pk %sV @%sms int %sVs"%(name,
+      format_range(s['rms'], '%.3g'), format_range(s['peak'], '%.3g'),
+      format_range(numpy.asarray(s['peak_time']) * 1e3, '%.4g'), format_range(s['integral'], '%.3g')))
+  return '; '.join(parts)
+
+def summary_lines(job, summaries):
+  """ The summary of a shot: one line, or one per device for multi-device shots """
+  if isinstance(summaries, dict):
+    names = { p.serial : p.names for p in job.device.scopes }
+    return [ "%s: %s"%(serial, format_summary(s, names[serial])) for serial, s in summaries.items() ]
+  return [ format_summary(summaries) ]
+
+def set_job_state(job, s):
+  job.state = s
+  bot.report("shot %d: %s"%(job.number, s), 'shot', s, number=job.number) # macros wait on these
+
+def release_job(job):
+  """ Return a shot's capture buffer once nothing can still write it """
+  if job is not None and job.buffer is not None and job is not state.last and job.state != 'writing':
+    state.p.releaseBuffer(job.buffer)
+    job.buffer = None
+    job.data = None
+
+def run_capture(device, arm, collect, arm_error, complete):
+  """ Arm the scope(s), then capture in the executor as a new Job.
+      collect(job) runs once the scope has triggered, returning (data, attrs, summaries). """
+  if state.current is not None:
+    sysmsg("ERROR: shot %d is still %s"%(state.current.number, state.current.state))
+    return
   try:
+    arm()
+  except:
+    handle_exception()
+    sysmsg(arm_error)
+    return
+  job = Job(device)
+  state.current = job
+  set_job_state(job, 'armed')
+  def capture():
+    # runs in the executor; the previous shot may be writing from the other buffer
+    device.waitReady()
+    bot.loop.call_soon_threadsafe(set_job_state, job, 'capturing')
+    job.data, job.attrs, job.summaries = collect(job)
+  def done(future):
+    state.current = None
+    if future.exception() is None:
+      previous, state.last = state.last, job
+      release_job(previous)
+      set_job_state(job, 'captured')
+      for line in summary_lines(job, job.summaries):
+        sysmsg("shot %d: %s"%(job.number, line))
+      sysmsg(complete)
+      if job.path is not None: # write_data came whilst we were capturing
+        write_job(job)
+    else:
+      print("Unexpected error:", future.exception())
+      set_job_state(job, 'failed')
+      if job.path is not None:
+        sysmsg("ERROR: shot %d failed, so nothing was written to %s"%(job.number, job.path + '.h5'))
+      release_job(job)
+  state.executor.submit(capture).add_done_callback(lambda f: bot.loop.call_soon_threadsafe(done, f))
+
+def start_capture(message):
+  def arm():
     state.p.setTimeout(int(message))
     state.p.startCollection()
-    state.p.collectData()
-    sysmsg("capture complete; use 'write_data' to save to disk as HDF5")
+  def collect(job):
+    job.buffer = state.p.acquireBuffer()
+    state.p.collectData(job.buffer)
+    return state.p.last_data, state.p.last_attrs, state.p.last_summaries
+  run_capture(state.p, arm, collect, 'ERROR: could not set timeout value to provided value %s'%message,
+              "capture complete; use 'write_data' to save to disk as HDF5")
+
+def start_burst(message):
+  elems = message.split()
+  try:
+    n, timeout = int(elems[0]), int(elems[1])
+  except:
+    sysmsg("ERROR: Need arguments <N_CAPTURES> <TIMEOUT_MS>")
+    return
+  if n < 1 or n > state.p.device.getMaxMemorySegments():
+    sysmsg("ERROR: Number of captures must be between 1 and %d"%state.p.device.getMaxMemorySegments())
+    return
+  def arm():
+    state.p.setTimeout(timeout)
+    samples = state.p.startBurst(n)
+    sysmsg("Capturing %d triggers of %d samples each"%(n, samples))
+  def collect(job):
+    state.p.collectBurst()
+    return state.p.last_data, state.p.last_attrs, state.p.last_summaries
+  run_capture(state.p, arm, collect, 'ERROR: could not arm the picoscope for %d captures'%n,
+              "burst of %d captures complete; use 'write_data' to save to disk as HDF5"%n)
+
+def start_multi(message):
+  if len(state.scopes.scopes) < 2:
+    sysmsg("ERROR: only one picoscope is open; use 'scopes' to open the others")
+    return
+  def arm():
+    state.scopes.setTimeout(int(message))
+    state.scopes.startCollection()
+  def collect(job):
+    state.scopes.collectData()
+    return state.scopes.last_data, state.scopes.last_attrs, state.scopes.last_summaries
+  run_capture(state.scopes, arm, collect, 'ERROR: could not arm the picoscopes with timeout %s'%message,
+              "capture on %d picoscopes complete; use 'write_data' to save to disk as HDF5"%len(state.scopes.scopes))
+
+def open_scopes(message):
+  try:
+    opened = state.scopes.connect()
   except:
     handle_exception()
-    sysmsg('ERROR: could not set timeout value to provided value %s'%message)
+    sysmsg("ERROR: could not open the attached picoscopes")
+    return
+  for serial in state.scopes.serials():
+    sysmsg("  %s%s"%(serial, " (newly opened)" if serial in opened else ""))
 
 def write_data(message):
+  # a shot still being captured is written once it has been, rather than
+  # the one before it
+  job = state.current or state.last
+  if job is None or (job is state.last and job.data is None):
+    sysmsg("ERROR: no data captured yet")
+    return
+  if job.state == 'writing' or (job is state.current and job.path is not None):
+    sysmsg("ERROR: shot %d is already being written to %s"%(job.number, job.path + '.h5'))
+    return
   if message == '':
     t = time.gmtime()
     timestamp = '_'.join([ str(t.tm_year), str(t.tm_mon), str(t.tm_mday), str(t.tm_hour), str(t.tm_min), str(t.tm_sec)] )
     path = 'C:\data\pico\%s'%timestamp
   else:
     path = message
-  state.p.writeHDF5(path)
-  sysmsg("Wrote HDF5 file %s"%(path + '.h5'))
+  job.path = path
+  if job is state.current:
+    sysmsg("shot %d is %s; it will be written to %s once captured"%(job.number, job.state, path + '.h5'))
+    return
+  write_job(job)
+
+def write_job(job):
+  path = job.path
+  set_job_state(job, 'writing')
+  def done(future):
+    if future.exception() is None:
+      set_job_state(job, 'done')
+      sysmsg("Wrote HDF5 file %s"%(path + '.h5'))
+    else:
+      print("Unexpected error:", future.exception())
+      set_job_state(job, 'failed')
+      sysmsg("ERROR: could not write HDF5 file %s"%(path + '.h5'))
+    release_job(job)
+  future = state.executor.submit(job.device.writeHDF5, path, job.data, job.attrs, job.summaries)
+  future.add_done_callback(lambda f: bot.loop.call_soon_threadsafe(done, f))
+
+def job_status(message):
+  for label, job in [ ('current', state.current), ('last', state.last) ]:
+    if job is not None:
+      sysmsg("%s shot %d: %s"%(label, job.number, job.state))
+  if state.current is None and state.last is None:
+    sysmsg("No shots yet")
+
+def stream_capture(message):
+  elems = message.split()
+  if len(elems) != 2:
+    sysmsg("ERROR: Need arguments <TIMEOUT_MS> <PATH_PREFIX>")
+    return
+  try:
+    state.p.setTimeout(int(elems[0]))
+    state.p.startCollection()
+  except:
+    handle_exception()
+    sysmsg('ERROR: could not arm the picoscope')
+    return
+  path = elems[1]
+  sysmsg("Armed; data will be streamed to %s"%(path + '.h5'))
+  def done(future):
+    if future.exception() is None:
+      sysmsg(format_summary(future.result()))
+      sysmsg("Wrote HDF5 file %s"%(path + '.h5'))
+    else:
+      print("Unexpected error:", future.exception())
+      sysmsg("ERROR: streaming capture to %s failed"%(path + '.h5'))
+  # transfer off the event loop, so the bot keeps answering whilst the capture runs
+  bot.loop.run_in_executor(None, state.p.streamData, path).add_done_callback(done)
+
+def set_codec(message):
+  try:
+    state.scopes.setCodec(message.strip()) # state.p is one of them
+    sysmsg("HDF5 codec set to %s"%message.strip())
+  except ValueError as e:
+    sysmsg("ERROR: %s"%e)
 
 def reset_scope(message):
   state.p.close()
@@ -63,11 +266,6 @@ def set_names(message):
     return
   state.p.setNames(elems)
 
-def usage(message):
-  sysmsg("%s understands the following commands:"%NICK)
-  for k,v in commands.items():
-    sysmsg('  ' + k + ' : ' + v[0])
-
 def status(message):
   if state.p.device != None:
     sysmsg("Picoscope attached")
@@ -150,55 +348,32 @@ def channel_config(message):
 #def setTimeout(self, timeout):
    
 commands = {
-    'start_capture' : ( 'start_capture <TIMEOUT_MS> arms the picoscope for capture', start_capture),
+    'start_capture' : ( 'start_capture <TIMEOUT_MS> arms the picoscope for capture; progress is reported as the shot moves through armed, capturing and captured', start_capture),
+    'start_burst' : ( 'start_burst <N_CAPTURES> <TIMEOUT_MS> arms the picoscope to capture N triggers into segmented memory; write_data then stores them with a segment dimension', start_burst),
+    'scopes' : ( 'opens every attached picoscope for multi-device capture and lists them', open_scopes),
+    'start_multi' : ( 'start_multi <TIMEOUT_MS> arms all open picoscopes together; write_data then stores them in one file with a group per device', start_multi),
+    'jobs' : ( 'shows the state of the current and last shots', job_status),
+    'stream_capture' : ( r'stream_capture <TIMEOUT_MS> <PATH_PREFIX> arms the picoscope, then streams the capture to disk in chunks as raw ADC counts (e.g stream_capture 5000 c:\data\foo)', stream_capture),
     'channel_config' : ('configures a chosen channel; e.g  channel_config <NAME> <COUPLING> <VOLTAGE_RANGE>', channel_config),
     'trig_threshold'  : (  'sets the voltage threshold (in Volts) used for triggering;  e.g trig_threshold 0.2', set_trig_thresh ),
     'trig_channel'  : (  'sets the channel used for triggering;  e.g "trig_channel A"  or "trig_channel External"', set_trig_channel ),
     'status'        : ( 'shows device configuration', status),
     'reset_scope'   : ( 'disconnects and reconnects scope', reset_scope),
     'write_data' : ( r'write_data <PATH_PREFIX> writes the last data set to disk in HDF5 format  (e.g write_data c:\data\foo)', write_data),
+    'codec' : ( 'codec <NAME> sets the HDF5 compression used by write_data (one of %s)'%', '.join(picointerface.codecs), set_codec),
     'channel_names' : ( 'channel_names <NAME_1> <NAME_2> <NAME_3> <NAME_4>   sets the names for the four device channels', set_names),
-    'help' : ( 'shows this useful message', usage),
 }
+# these talk to the device directly, which can take a while
+bot.add_commands(commands, blocking=[ 'reset_scope', 'scopes' ])
+
+def connect():
+  state.p.connect()
+  state.p.setDefaults()
 
-@bot.on('CLIENT_CONNECT')
-def connect(**kwargs):
-    print("Connected")
-    state.p.connect()
-    state.p.setDefaults()
-    bot.send('NICK', nick=NICK)
-    bot.send('USER', user=NICK,
-             realname='iamthetalkingrobot')
-    bot.send('JOIN', channel=CHANNEL)
-
-@bot.on("client_disconnect")
-async def reconnect(**kwargs):
-    await asyncio.sleep(3, loop=bot.loop)
-    bot.loop.create_task(bot.connect())
-    state.p.close()
-
-@bot.on('PING')
-def keepalive(message, **kwargs):
-    bot.send('PONG', message=message)
-
-@bot.on('PRIVMSG')
-def message(nick, target, message, **kwargs):
-    """ Echo all messages """
-    # Don't echo ourselves
-    if nick == NICK:
-        return
-    if message.startswith(NICK + ": "):
-        stripped = message.split(NICK+': ')
-        if len(stripped) > 1:
-          command = ''.join(stripped[1:]).strip()
-          base = command.split()[0]
-          if base in commands.keys():
-            commands[base][1](' '.join(command.split()[1:]))
-          else:
-            sysmsg("ERROR: Command not understood")
+bot.on_connect(connect)
+bot.on_disconnect(state.p.close)
 
 try:
-  bot.loop.create_task(bot.connect())
-  bot.loop.run_forever()
+  bot.run()
 finally:
   state.p.close()
\ No newline at end of file
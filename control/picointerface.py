@@ -6,8 +6,290 @@ import time
 import logging
 import numpy as np
 import h5py
+import queue
+import threading
+import collections
+import zlib
+import concurrent.futures
 
-# NB - This class only supports a single picoscope at the moment.
+try:
+  import hdf5plugin # provides the blosc filter, if installed
+except ImportError:
+  hdf5plugin = None
+
+# NB - PicoScope drives a single picoscope; PicoScopeManager runs several
+# together, one PicoScope each.
+
+# HDF5 codecs for capture data. 'gzip1' (byte shuffle + deflate level 1)
+# compresses chunks in a thread pool; the others go through the HDF5 filter
+# pipeline, which h5py runs one dataset at a time.
+codecs = [ 'gzip1', 'lzf', 'blosc', 'none' ]
+hdf5_chunk_size = 1 << 20  # samples per HDF5 chunk
+
+def filterOptions(codec):
+  """ create_dataset keyword arguments for the named codec """
+  if codec == 'gzip1':
+    return { 'compression' : 'gzip', 'compression_opts' : 1, 'shuffle' : True }
+  if codec == 'lzf':
+    return { 'compression' : 'lzf', 'shuffle' : True }
+  if codec == 'blosc':
+    if hdf5plugin is None:
+      raise ValueError("the blosc codec needs the hdf5plugin package")
+    return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+  if codec == 'none':
+    return {}
+  raise ValueError("Unknown codec %s (choose from %s)"%(codec, ', '.join(codecs)))
+
+def deflateChunk(chunk, chunk_size):
+  """ Compress one chunk exactly as HDF5's shuffle+deflate(1) filters would.
+      zlib releases the GIL, so chunks compress in parallel across threads. """
+  if len(chunk) < chunk_size: # edge chunks are stored full size
+    padded = np.zeros(chunk_size, dtype=chunk.dtype)
+    padded[:len(chunk)] = chunk
+    chunk = padded
+  shuffled = np.ascontiguousarray(chunk.view(np.uint8).reshape(-1, chunk.itemsize).T)
+  return zlib.compress(shuffled, 1)
+
+def writeChannels(h5f, names, data, attrs, codec='gzip1', chunk_size=hdf5_chunk_size, workers=4):
+  """ Write channel arrays to h5f as chunked, compressed datasets.
+      Arrays are 1-d, or (segments, samples) for segmented captures; chunks
+      run along the last axis, one segment at a time. """
+  datasets = []
+  for name, d, a in zip(names, data, attrs):
+    if d.size == 0:
+      ds = h5f.create_dataset(name, data=d)
+    else:
+      chunks = (1,)*(d.ndim - 1) + (min(chunk_size, d.shape[-1]),)
+      ds = h5f.create_dataset(name, shape=d.shape, dtype=d.dtype, chunks=chunks, **filterOptions(codec))
+    ds.attrs.update(a)
+    datasets.append(ds)
+  if codec == 'gzip1':
+    def chunks():
+      for ds, d in zip(datasets, data):
+        if d.size == 0:
+          continue
+        c = ds.chunks[-1]
+        for segment in np.ndindex(d.shape[:-1]):
+          row = d[segment]
+          for start in range(0, len(row), c):
+            yield ds, segment + (start,), row[start:start+c], c
+    # at most 2*workers compressed chunks are held at once; writing a
+    # precompressed chunk is just I/O, so one thread keeps up, in order
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+      jobs = collections.deque()
+      def write_oldest():
+        ds, offset, job = jobs.popleft()
+        ds.id.write_direct_chunk(offset, job.result())
+      for ds, offset, chunk, c in chunks():
+        if len(jobs) >= 2*workers:
+          write_oldest()
+        jobs.append((ds, offset, pool.submit(deflateChunk, chunk, c)))
+      while jobs:
+        write_oldest()
+  else:
+    for ds, d in zip(datasets, data):
+      if d.size > 0:
+        ds[...] = d
+  return datasets
+
+def toVolts(raw, attrs):
+  """ Convert raw ADC counts to volts using a channel's scale and offset """
+  return raw * attrs['scale'] - attrs['offset']
+
+class VoltageView:
+  """ Read-only view of a raw int16 dataset that converts to volts on access,
+      so only the slices actually read are ever held as floats """
+
+  def __init__(self, raw, attrs):
+    self.raw = raw
+    self.attrs = attrs
+
+  @property
+  def shape(self):
+    return self.raw.shape
+
+  def __len__(self):
+    return len(self.raw)
+
+  def __getitem__(self, key):
+    return toVolts(self.raw[key], self.attrs)
+
+  def __array__(self, dtype=None, copy=None):
+    v = self[()]
+    return v if dtype is None else v.astype(dtype)
+
+def readHDF5(filename):
+  """ Open a file written by PicoScope or PicoScopeManager; returns
+      (h5py.File, { name : VoltageView }). Channels of a multi-device file
+      are named <device>/<channel>. Summaries are not included. """
+  h5f = h5py.File(filename, 'r')
+  channels = {}
+  def visit(group, prefix):
+    for name, item in group.items():
+      if isinstance(item, h5py.Group):
+        if name != 'summary':
+          visit(item, prefix + name + '/')
+      elif 'scale' in item.attrs:
+        channels[prefix + name] = VoltageView(item, dict(item.attrs))
+  visit(h5f, '')
+  return h5f, channels
+
+def enumerateUnits():
+  """ Serial numbers of the attached (and not yet opened) ps3000a units """
+  return ps3000a.PS3000a(connect=False).enumerateUnits()
+
+# Samples per point of the min/max envelopes stored with each capture; each
+# level must be a multiple of the first.
+decimation_levels = [ 256, 4096, 65536 ]
+
+def reduceRuns(x, factor, reduce):
+  """ Apply reduce (np.minimum or np.maximum) to each run of factor values;
+      a short final run is reduced on its own """
+  m = len(x) // factor * factor
+  out = reduce.reduce(x[:m].reshape(-1, factor), axis=1)
+  if m < len(x):
+    out = np.append(out, reduce.reduce(x[m:]))
+  return out
+
+class Summary:
+  """ Accumulates min/max envelopes and summary statistics of one channel's
+      raw samples, a chunk at a time, so they can be had without holding or
+      rereading the full-resolution data. Chunks may be of any length. """
+
+  def __init__(self, attrs, levels=decimation_levels):
+    self.attrs = attrs
+    self.levels = levels
+    self.n = 0
+    self.total = 0           # sum of raw counts
+    self.total_squares = 0   # sum of squared raw counts
+    self.lo = (np.iinfo(np.int16).max, 0) # (raw value, sample index)
+    self.hi = (np.iinfo(np.int16).min, 0)
+    self.mins = []           # finest envelope, piece by piece
+    self.maxs = []
+    self.carry = np.empty(0, dtype=np.int16) # samples short of a whole envelope point
+
+  def add(self, chunk):
+    if len(chunk) == 0:
+      return
+    wide = chunk.astype(np.int64)
+    self.total += int(wide.sum())
+    self.total_squares += int(np.dot(wide, wide))
+    i = int(chunk.argmin())
+    if chunk[i] < self.lo[0]:
+      self.lo = (int(chunk[i]), self.n + i)
+    i = int(chunk.argmax())
+    if chunk[i] > self.hi[0]:
+      self.hi = (int(chunk[i]), self.n + i)
+    self.n += len(chunk)
+    if len(self.carry):
+      chunk = np.concatenate((self.carry, chunk))
+    step = self.levels[0]
+    m = len(chunk) // step * step
+    blocks = chunk[:m].reshape(-1, step)
+    self.mins.append(blocks.min(axis=1))
+    self.maxs.append(blocks.max(axis=1))
+    self.carry = chunk[m:].copy()
+
+  def result(self):
+    """ Returns a dict of the statistics, in volts and seconds, plus
+        'envelopes' : { level : (mins, maxs) } in raw counts """
+    mins, maxs = self.mins, self.maxs
+    if len(self.carry):
+      mins = mins + [ self.carry.min(keepdims=True) ]
+      maxs = maxs + [ self.carry.max(keepdims=True) ]
+    mins = np.concatenate(mins) if mins else np.empty(0, dtype=np.int16)
+    maxs = np.concatenate(maxs) if maxs else np.empty(0, dtype=np.int16)
+    envelopes = {}
+    for level in self.levels:
+      factor = level // self.levels[0]
+      envelopes[level] = (reduceRuns(mins, factor, np.minimum), reduceRuns(maxs, factor, np.maximum))
+    scale, offset = self.attrs['scale'], self.attrs['offset']
+    dt = self.attrs['sampling_interval']
+    n = max(self.n, 1)
+    mean_raw = self.total / n
+    mean_square = scale*scale*self.total_squares/n - 2*scale*offset*mean_raw + offset*offset
+    peak_raw, peak_index = max(self.lo, self.hi, key=lambda p: abs(p[0]*scale - offset))
+    return { 'mean' : scale*mean_raw - offset,
+             'rms' : np.sqrt(max(mean_square, 0.0)),
+             'integral' : (scale*self.total - offset*self.n) * dt, # V s
+             'peak' : peak_raw*scale - offset,
+             'peak_time' : peak_index * dt,
+             'envelopes' : envelopes }
+
+summary_fields = [ 'mean', 'rms', 'integral', 'peak', 'peak_time' ]
+
+def summarise(raw, attrs, chunk_size=hdf5_chunk_size, levels=decimation_levels):
+  """ Summary of a channel's raw samples, in chunks of chunk_size.
+      For (segments, samples) arrays each statistic becomes an array over
+      segments, and each envelope a (segments, points) array. """
+  rows = raw.reshape(-1, raw.shape[-1])
+  results = []
+  for row in rows:
+    s = Summary(attrs, levels)
+    for start in range(0, len(row), chunk_size):
+      s.add(row[start:start+chunk_size])
+    results.append(s.result())
+  if raw.ndim == 1:
+    return results[0]
+  summary = { k : np.array([ r[k] for r in results ]).reshape(raw.shape[:-1]) for k in summary_fields }
+  summary['envelopes'] = { level : tuple(np.stack([ r['envelopes'][level][i] for r in results ]).reshape(raw.shape[:-1] + (-1,))
+                                         for i in range(2))
+                           for level in levels }
+  return summary
+
+def writeSummaries(h5f, names, summaries, attrs):
+  """ Store summaries as summary/<channel>: the statistics as group attributes,
+      and each envelope as raw-count datasets min_<level> and max_<level> """
+  for name, summary, a in zip(names, summaries, attrs):
+    g = h5f.require_group('summary').create_group(name)
+    g.attrs.update({ k : summary[k] for k in summary_fields })
+    for level, (mins, maxs) in summary['envelopes'].items():
+      for label, d in [ ('min', mins), ('max', maxs) ]:
+        ds = g.create_dataset('%s_%d'%(label, level), data=d)
+        ds.attrs.update({ 'scale' : a['scale'], 'offset' : a['offset'], 'decimation' : level,
+                          'sampling_interval' : a['sampling_interval'] * level })
+
+class ChunkWriter(threading.Thread):
+  """ Writes chunks of raw samples into a HDF5 file as they arrive,
+      handing each buffer back to the free ring once it is on disk """
+
+  def __init__(self, path, names, nSamples, chunk_size, attrs, free, codec='gzip1'):
+    super().__init__()
+    self.codec = codec
+    self.path = path
+    self.names = names
+    self.nSamples = nSamples
+    self.chunk_size = chunk_size
+    self.attrs = attrs      # per-channel dicts of dataset attributes
+    self.free = free        # queue of buffers available for reuse
+    self.chunks = queue.Queue()
+    self.error = None
+
+  def run(self):
+    h5f = None
+    try:
+      h5f = h5py.File(self.path + '.h5', 'w')
+      datasets = []
+      for name, attrs in zip(self.names, self.attrs):
+        d = h5f.create_dataset(name, shape=(self.nSamples,), dtype=np.int16,
+                               chunks=(min(self.chunk_size, self.nSamples),), **filterOptions(self.codec))
+        d.attrs.update(attrs)
+        datasets.append(d)
+    except Exception as e:
+      self.error = e
+    while True:
+      item = self.chunks.get()
+      if item is None:
+        break
+      channel, start, n, buf = item
+      if self.error is None:
+        try:
+          datasets[channel][start:start+n] = buf[:n]
+        except Exception as e:
+          self.error = e
+      self.free.put(buf)
+    if h5f is not None:
+      h5f.close()
 
 class PicoScope:
 
@@ -16,9 +298,22 @@ class PicoScope:
   trigger_channel = 'External'
   trigger_threshold = 0.2 # V
   trigger_timeout = 5000 # ms
+  chunk_size = 1 << 20   # samples per channel transferred in one getDataRaw call
+  n_buffers = 8          # chunk buffers in the ring shared with the writer
+  codec = 'gzip1'        # HDF5 compression; one of picointerface.codecs
+  sampling_interval = 4e-9 # s
+  sampling_window = 100e-3 # s
+  n_segments = 1         # captures per arm; > 1 whilst a burst is pending
+  n_capture_buffers = 2  # so one shot can be written whilst the next is collected
+  capture_buffers = None # per buffer, a list of one int16 array per channel
+  free_buffers = None    # queue of indices into capture_buffers not in use
 
-  def connect(self):
-    self.device = ps3000a.PS3000a()
+  serial = None
+
+  def connect(self, serial=None):
+    """ Open the unit with the given serial number, or the first one found """
+    self.device = ps3000a.PS3000a(serialNumber=serial)
+    self.serial = self.device.getUnitInfo('BatchAndSerial')
 
   def updateTrigger(self):
     self.device.setSimpleTrigger(self.trigger_channel, 
@@ -27,16 +322,27 @@ class PicoScope:
   
   def setDefaults(self):
     self.last_data = []  
+    self.last_attrs = []
+    self.last_summaries = []
     self.device.setChannel(channel="A", coupling="AC", VRange=1)
     self.device.setChannel(channel="B", coupling="AC", VRange=1)
     self.device.setChannel(channel="C", coupling="AC", VRange=1)
     self.device.setChannel(channel="D", coupling="AC", VRange=1)
     self.device.setSimpleTrigger(self.trigger_channel, threshold_V=0.2, timeout_ms=self.trigger_timeout) #trigger above 0.2V, otherwise force trigger after 5s.
-    (self.actualSamplingInterval, self.nSamples, self.maxSamples) = self.device.setSamplingInterval(4e-9, 100e-3) # 4ns period, 100ms window
+    (self.actualSamplingInterval, self.nSamples, self.maxSamples) = self.device.setSamplingInterval(self.sampling_interval, self.sampling_window) # 4ns period, 100ms window
+    if self.free_buffers is None:
+      self.capture_buffers = [ None ]*self.n_capture_buffers
+      self.free_buffers = queue.Queue()
+      for i in range(self.n_capture_buffers):
+        self.free_buffers.put(i)
       
   def close(self):
     self.device.close()
 
+  def setCodec(self, codec):
+    filterOptions(codec) # raises ValueError if unknown or unavailable
+    self.codec = codec
+
   def setNames(self, names):
     self.names = names
 
@@ -58,28 +364,149 @@ class PicoScope:
     self.trigger_timeout = timeout
     self.updateTrigger()
 
-  def collectData(self):
+  def acquireBuffer(self):
+    """ Reserve a capture buffer for collectData, blocking until one is free """
+    i = self.free_buffers.get()
+    b = self.capture_buffers[i]
+    if b is None or len(b[0]) != self.nSamples:
+      self.capture_buffers[i] = [ np.empty(self.nSamples, dtype=np.int16) for c in range(4) ]
+    return i
+
+  def releaseBuffer(self, i):
+    self.free_buffers.put(i)
+
+  def waitReady(self):
+    self.device.waitReady()
+
+  def collectData(self, buffer=None):
+    """ Fetch the captured block as raw int16 ADC counts, one array per channel,
+        into the given capture buffer (from acquireBuffer) or into new arrays.
+        Use volts(i) (or toVolts with last_attrs[i]) to convert. """
     data = []
+    attrs = []
     self.device.waitReady()
-    data.append(self.device.getDataV('A', self.nSamples))
-    data.append(self.device.getDataV('B', self.nSamples))
-    data.append(self.device.getDataV('C', self.nSamples))
-    data.append(self.device.getDataV('D', self.nSamples))
+    for ix, c in enumerate([ 'A', 'B', 'C', 'D' ]):
+      out = None if buffer is None else self.capture_buffers[buffer][ix]
+      (raw, n, overflow) = self.device.getDataRaw(c, self.nSamples, data=out)
+      data.append(raw[:n])
+      attrs.append(self.channelAttrs(c))
     self.device.stop()
     self.last_data = data
+    self.last_attrs = attrs
+    self.last_summaries = [ summarise(d, a, self.chunk_size) for d, a in zip(data, attrs) ]
     return data
 
-  def writeHDF5(self, path):
+  def startBurst(self, n_captures):
+    """ Arm for n_captures triggers in rapid block mode, each captured into its
+        own segment of device memory; collect them with collectBurst.
+        Each segment holds at most 1/n_captures of the memory, so the window
+        is shortened if need be. Returns the samples per segment. """
+    try:
+      maxSamples = self.device.memorySegments(n_captures)
+      self.device.setNoOfCaptures(n_captures)
+      window = min(self.sampling_window, maxSamples * self.sampling_interval)
+      (self.actualSamplingInterval, self.nSamples, self.maxSamples) = self.device.setSamplingInterval(self.sampling_interval, window)
+      self.n_segments = n_captures
+      self.device.runBlock()
+    except:
+      self.endBurst()
+      raise
+    return self.nSamples
+
+  def endBurst(self):
+    """ Return to a single segment covering the whole window """
+    self.n_segments = 1
+    self.device.memorySegments(1)
+    self.device.setNoOfCaptures(1)
+    (self.actualSamplingInterval, self.nSamples, self.maxSamples) = self.device.setSamplingInterval(self.sampling_interval, self.sampling_window)
+
+  def collectBurst(self):
+    """ Wait for every capture of a burst, then download all segments of
+        each channel in one bulk transfer. Returns one (segments, samples)
+        int16 array per channel, also kept as last_data. """
+    data = []
+    attrs = []
+    try:
+      self.device.waitReady()
+      for c in [ 'A', 'B', 'C', 'D' ]:
+        (raw, n, overflow) = self.device.getDataRawBulk(c, self.nSamples, 0, self.n_segments - 1)
+        data.append(raw[:, :n])
+        a = self.channelAttrs(c)
+        a['segments'] = self.n_segments
+        a['overflow'] = np.asarray(overflow) != 0 # per segment
+        attrs.append(a)
+      self.device.stop()
+    finally:
+      self.endBurst()
+    self.last_data = data
+    self.last_attrs = attrs
+    self.last_summaries = [ summarise(d, a, self.chunk_size) for d, a in zip(data, attrs) ]
+    return data
+
+  def volts(self, i):
+    """ Channel i of the last capture, in volts """
+    return toVolts(self.last_data[i], self.last_attrs[i])
+
+  def channelAttrs(self, channel):
+    scale_and_offset = self.device.getScaleAndOffset(channel)
+    return { 'scale' : scale_and_offset['scale'],      # volts = raw * scale - offset
+             'offset' : scale_and_offset['offset'],
+             'sampling_interval' : self.actualSamplingInterval }
+
+  def streamData(self, path):
+    """ Transfer the captured block to path.h5 in chunks of chunk_size samples.
+        Chunks are pulled with getDataRaw into a fixed ring of buffers and
+        written by a separate thread, so memory use is bounded by the ring
+        rather than the length of the capture. Summaries are accumulated
+        from the chunks on the way past, written with the data and returned. """
     directory = os.path.dirname(path)
-    if not os.path.exists(directory):
+    if directory and not os.path.exists(directory):
       os.makedirs(directory)
-    print()
-    h5f = h5py.File(path + '.h5')
-    h5f.create_dataset(self.names[0], data = self.last_data[0], compression='gzip')
-    h5f.create_dataset(self.names[1], data = self.last_data[1], compression='gzip')
-    h5f.create_dataset(self.names[2], data = self.last_data[2], compression='gzip')
-    h5f.create_dataset(self.names[3], data = self.last_data[3], compression='gzip')
-    h5f.close()
+    free = queue.Queue()
+    for i in range(self.n_buffers):
+      free.put(np.empty(self.chunk_size, dtype=np.int16))
+    channels = [ 'A', 'B', 'C', 'D' ]
+    attrs = [ self.channelAttrs(c) for c in channels ]
+    summaries = [ Summary(a) for a in attrs ]
+    writer = ChunkWriter(path, self.names, self.nSamples, self.chunk_size, attrs, free, self.codec)
+    writer.start()
+    try:
+      self.device.waitReady()
+      for start in range(0, self.nSamples, self.chunk_size):
+        n = min(self.chunk_size, self.nSamples - start)
+        for ix, c in enumerate(channels):
+          buf = free.get() # blocks whilst the writer is behind
+          (data, n_returned, overflow) = self.device.getDataRaw(c, n, startIndex=start, data=buf)
+          summaries[ix].add(buf[:n_returned])
+          writer.chunks.put((ix, start, n_returned, buf))
+      self.device.stop()
+    finally:
+      writer.chunks.put(None)
+      writer.join()
+    if writer.error is not None:
+      raise writer.error
+    summaries = [ s.result() for s in summaries ]
+    h5f = h5py.File(path + '.h5', 'a')
+    try:
+      writeSummaries(h5f, self.names, summaries, attrs)
+    finally:
+      h5f.close()
+    return summaries
+
+  def writeHDF5(self, path, data=None, attrs=None, summaries=None):
+    """ Write data (by default, the last capture) and its summaries to path.h5 """
+    if data is None:
+      data, attrs, summaries = self.last_data, self.last_attrs, self.last_summaries
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    h5f = h5py.File(path + '.h5', 'w')
+    try:
+      writeChannels(h5f, self.names, data, attrs, self.codec)
+      if summaries:
+        writeSummaries(h5f, self.names, summaries, attrs)
+    finally:
+      h5f.close()
 
   def test(self):
     self.connect()
@@ -89,4 +516,96 @@ class PicoScope:
     self.close()
     return self.last_data
 
- 
\ No newline at end of file
+
+class PicoScopeManager:
+  """ Runs several picoscopes as one: all are armed before any is waited on,
+      then each is waited on and downloaded in its own thread, and a shot is
+      written as one HDF5 file with a group per device. Per-device settings
+      (channels, triggers, names) are made on the PicoScope objects in scopes. """
+
+  codec = 'gzip1' # HDF5 compression of multi-device shots; one of picointerface.codecs
+
+  def __init__(self, scopes=None):
+    self.scopes = list(scopes or []) # already-connected PicoScopes to include
+
+  def setCodec(self, codec):
+    """ Use codec for multi-device shots and for every scope's own shots """
+    filterOptions(codec) # raises ValueError if unknown or unavailable
+    self.codec = codec
+    for p in self.scopes:
+      p.setCodec(codec)
+
+  def connect(self, serials=None):
+    """ Open the units with the given serial numbers (by default, every unit
+        attached) that are not already open. Returns the serials opened. """
+    if serials is None:
+      serials = enumerateUnits()
+    known = set(s.serial for s in self.scopes)
+    opened = []
+    for serial in serials:
+      if serial not in known:
+        p = PicoScope()
+        p.connect(serial)
+        p.setDefaults()
+        p.setCodec(self.codec)
+        self.scopes.append(p)
+        opened.append(serial)
+    return opened
+
+  def close(self):
+    for p in self.scopes:
+      p.close()
+    self.scopes = []
+
+  def serials(self):
+    return [ p.serial for p in self.scopes ]
+
+  def map(self, f):
+    """ Call f(scope) for every scope concurrently; returns { serial : result } """
+    with concurrent.futures.ThreadPoolExecutor(max(len(self.scopes), 1)) as pool:
+      results = pool.map(f, self.scopes)
+      return dict(zip(self.serials(), results))
+
+  def setTimeout(self, timeout):
+    for p in self.scopes:
+      p.setTimeout(timeout)
+
+  def startCollection(self):
+    # runBlock returns as soon as the unit is armed, so a plain loop arms
+    # every unit before the (shared) trigger can arrive
+    for p in self.scopes:
+      p.startCollection()
+
+  def waitReady(self):
+    self.map(PicoScope.waitReady)
+
+  def collectData(self):
+    """ Download every scope's capture concurrently. Returns { serial : data };
+        attrs and summaries are in last_attrs and last_summaries likewise. """
+    self.last_data = self.map(PicoScope.collectData)
+    self.last_attrs = { p.serial : p.last_attrs for p in self.scopes }
+    self.last_summaries = { p.serial : p.last_summaries for p in self.scopes }
+    return self.last_data
+
+  def groupName(self, serial):
+    return serial.replace('/', '_') # serials look like AB123/0001
+
+  def writeHDF5(self, path, data=None, attrs=None, summaries=None):
+    """ Write the last shot (or the given { serial : ... } dicts) to path.h5,
+        with each device's channels and summaries in a group of its own """
+    if data is None:
+      data, attrs, summaries = self.last_data, self.last_attrs, self.last_summaries
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    names = { p.serial : p.names for p in self.scopes }
+    h5f = h5py.File(path + '.h5', 'w')
+    try:
+      for serial in data:
+        g = h5f.create_group(self.groupName(serial))
+        g.attrs['serial'] = serial
+        writeChannels(g, names[serial], data[serial], attrs[serial], self.codec)
+        if summaries:
+          writeSummaries(g, names[serial], summaries[serial], attrs[serial])
+    finally:
+      h5f.close()
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+# Benchmark for downloading screen contents from several Rigol scopes.
+#
+# Usage:  python rigol_bench.py [N_SCOPES] [LATENCY_MS] [MEMORY_DEPTH]
+#
+# Each scope is simulated by a local SCPI-over-TCP server that answers the
+# :WAVeform queries ds1054z makes, waiting LATENCY_MS before every reply to
+# stand in for the scope and the network. The serial loop that
+# getScopeScreenContents used to run is compared with WaveformFetcher; a
+# scope that never answers checks that the others are still returned.
+# Deep-memory reads with rawWaveform are compared with the way ds1054z
+# assembles and converts RAW mode data.
+
+import sys
+import time
+import socket
+import threading
+import socketserver
+import numpy as np
+import rigol_data
+
+SAMPLES_ON_DISPLAY = 1200
+
+class FakeScopeHandler(socketserver.StreamRequestHandler):
+  """ Answers newline-terminated SCPI commands like a DS1054Z on its raw socket port """
+
+  def handle(self):
+    rng = np.random.default_rng(self.server.server_address[1])
+    waveform = rng.integers(0, 256, SAMPLES_ON_DISPLAY, dtype=np.uint8).tobytes()
+    memory = rng.integers(0, 256, self.server.depth, dtype=np.uint8).tobytes()
+    mode, start, stop = 'NORMal', 1, SAMPLES_ON_DISPLAY
+    for line in self.rfile:
+      command = line.decode().strip()
+      if command.startswith(':WAVeform:MODE '):
+        mode = command.split()[1]
+      elif command.startswith(':WAVeform:STARt '):
+        start = int(command.split()[1])
+      elif command.startswith(':WAVeform:STOP '):
+        stop = int(command.split()[1])
+      if not command.endswith('?'):
+        continue
+      time.sleep(self.server.latency)
+      if self.server.hang:
+        time.sleep(3600)
+      if command == ':WAVeform:PREamble?':
+        points = len(memory) if mode == 'RAW' else SAMPLES_ON_DISPLAY
+        reply = b'0,0,%d,1,2.000000e-05,-1.200000e-02,0,4.000000e-02,-75,127\n'%points
+      elif command == ':WAVeform:DATA?':
+        block = memory[start-1:stop] if mode == 'RAW' else waveform
+        reply = b'#9%09d'%len(block) + block + b'\n'
+      elif command.endswith(':DISPlay?'):
+        reply = b'1\n' if command.startswith(':CHAN') else b'0\n'
+      elif command == ':TRIGger:STATus?':
+        reply = b'STOP\n'
+      elif command == ':ACQuire:MDEPth?':
+        reply = b'1200\n'
+      else:
+        reply = b'0\n'
+      self.wfile.write(reply)
+
+class FakeScopeServer(socketserver.ThreadingTCPServer):
+  daemon_threads = True
+
+  def __init__(self, latency, hang=False, depth=12000):
+    super().__init__(('127.0.0.1', 0), FakeScopeHandler)
+    self.latency = latency
+    self.hang = hang
+    self.depth = depth
+    threading.Thread(target=self.serve_forever, daemon=True).start()
+
+class SocketScope:
+  """ The parts of ds1054z.DS1054Z that rigol_data uses, over a raw socket """
+
+  def __init__(self, port):
+    self.socket = socket.create_connection(('127.0.0.1', port))
+    self.rfile = self.socket.makefile('rb')
+
+  def write(self, command):
+    self.socket.sendall(command.encode() + b'\n')
+
+  def query_raw(self, command):
+    self.write(command)
+    if command == ':WAVeform:DATA?': # an IEEE 488.2 block, which may contain newlines
+      header = self.rfile.read(2)
+      length = self.rfile.read(int(header[1:2]))
+      data = self.rfile.read(int(length))
+      self.rfile.readline()
+      return header + length + data
+    return self.rfile.readline().strip()
+
+  def query(self, command):
+    return self.query_raw(command).decode()
+
+  @property
+  def running(self):
+    return self.query(':TRIGger:STATus?') in ('TD', 'WAIT', 'RUN', 'AUTO')
+
+  def stop(self):
+    self.write(':STOP')
+
+  def run(self):
+    self.write(':RUN')
+
+  @property
+  def displayed_channels(self):
+    return [ c for c in ('CHAN1', 'CHAN2', 'CHAN3', 'CHAN4', 'MATH') if self.query(':%s:DISPlay?'%c) == '1' ]
+
+  @property
+  def waveform_preamble(self):
+    values = self.query(':WAVeform:PREamble?').split(',')
+    return [ int(v) for v in values[:4] ] + [ float(v) for v in values[4:6] ] + [ int(values[6]), float(values[7]), int(values[8]), int(values[9]) ]
+
+  def get_waveform_samples(self, channel):
+    self.write(':WAVeform:SOURce CHAN%d'%channel)
+    self.write(':WAVeform:FORMat BYTE')
+    self.write(':WAVeform:MODE NORMal')
+    fmt, typ, pnts, cnt, xinc, xorig, xref, yinc, yorig, yref = self.waveform_preamble
+    self.write(':WAVeform:STARt 1')
+    self.write(':WAVeform:STOP %d'%pnts)
+    buff = rigol_data.decodeBlock(self.query_raw(':WAVeform:DATA?'))
+    return [ (val - yorig - yref)*yinc for val in buff ]
+
+  @property
+  def waveform_time_values(self):
+    fmt, typ, pnts, cnt, xinc, xorig, xref, yinc, yorig, yref = self.waveform_preamble
+    depth = int(self.query(':ACQuire:MDEPth?'))
+    return [ xinc * i + xorig for i in range(depth) ]
+
+def serial_contents(scopes):
+  """ The loop getScopeScreenContents used to run """
+  data = dict()
+  for key, d in scopes.items():
+    data[key] = dict()
+    for channel in range(4):
+      data[key]["Channel_%d"%(channel+1)] = (d.get_waveform_samples(channel+1), d.waveform_time_values)
+  return data
+
+def ds1054z_raw_samples(scope, channel):
+  """ What ds1054z's get_waveform_samples(channel, mode='RAW') does with the data """
+  scope.write(':WAVeform:SOURce CHAN%d'%channel)
+  scope.write(':WAVeform:FORMat BYTE')
+  scope.write(':WAVeform:MODE RAW')
+  fmt, typ, pnts, cnt, xinc, xorig, xref, yinc, yorig, yref = scope.waveform_preamble
+  buff = b''
+  pos = 1
+  while len(buff) < pnts:
+    scope.write(':WAVeform:STARt %d'%pos)
+    scope.write(':WAVeform:STOP %d'%min(pnts, pos + rigol_data.raw_chunk_size - 1))
+    buff += bytes(rigol_data.decodeBlock(scope.query_raw(':WAVeform:DATA?')))
+    pos += rigol_data.raw_chunk_size
+  return [ (val - yorig - yref)*yinc for val in buff ]
+
+def raw_samples(scope, channel):
+  raw, preamble = rigol_data.rawWaveform(scope, channel)
+  return rigol_data.rawToVolts(raw, preamble)
+
+def timed(f, *args):
+  t0 = time.perf_counter()
+  result = f(*args)
+  return time.perf_counter() - t0, result
+
+def main():
+  n_scopes = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+  latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+  servers = [ FakeScopeServer(latency) for i in range(n_scopes) ]
+  scopes = { 'scope_%d'%i : SocketScope(s.server_address[1]) for i, s in enumerate(servers) }
+  print("%d scopes, %g ms per reply"%(n_scopes, latency*1000))
+
+  t_serial, expected = timed(serial_contents, scopes)
+  print("  serial loop       : %6.3f s"%t_serial)
+  fetcher = rigol_data.WaveformFetcher()
+  t_parallel, (data, failures) = timed(fetcher.fetch, scopes)
+  assert data == expected and not failures, "parallel download disagrees"
+  print("  WaveformFetcher   : %6.3f s  (%.1fx)"%(t_parallel, t_serial/t_parallel))
+
+  # a scope that stops answering costs only the timeout
+  hung = FakeScopeServer(latency, hang=True)
+  scopes['hung'] = SocketScope(hung.server_address[1])
+  t_partial, (data, failures) = timed(fetcher.fetch, scopes, rigol_data.screen_contents, 1.0)
+  assert sorted(data) == sorted(expected) and list(failures) == ['hung']
+  print("  with a hung scope : %6.3f s  (1 s timeout; %s: %s)"%(t_partial, 'hung', failures['hung']))
+  scopes['hung'].socket.shutdown(socket.SHUT_RDWR) # release its worker, so we can exit
+
+  depth = int(sys.argv[3]) if len(sys.argv) > 3 else 3000000
+  scope = SocketScope(FakeScopeServer(0, depth=depth).server_address[1])
+  print("Deep memory, %d points per channel"%depth)
+  t_list, expected = timed(ds1054z_raw_samples, scope, 1)
+  print("  ds1054z style     : %6.3f s"%t_list)
+  t_array, volts = timed(raw_samples, scope, 1)
+  assert np.allclose(volts, expected), "raw conversion disagrees"
+  print("  rawWaveform       : %6.3f s  (%.1fx)"%(t_array, t_list/t_array))
+  t_all, data = timed(rigol_data.raw_contents, scope)
+  print("  raw_contents      : %6.3f s  (%s)"%(t_all, ', '.join(sorted(data))))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,223 @@
+# Waveform download from Rigol DS1000Z scopes.
+#
+# Each scope has a single SCPI connection, so its channels are read one after
+# another, but separate scopes are read in parallel, one worker thread each.
+# A scope that does not finish within the timeout is reported as failed and
+# left out of the results, rather than holding up the others; it is skipped
+# by later downloads until its worker gives up.
+#
+# A shot (the data from every scope) is saved as one HDF5 or .npz file of
+# float arrays; CSV is written from the same arrays, for those who want text.
+#
+# Deep-memory (RAW mode) reads return the scope's bytes untouched, with the
+# preamble needed to turn them into volts and seconds, and are saved that way.
+
+import concurrent.futures
+import os
+import numpy as np
+
+try:
+  import h5py
+except ImportError:
+  h5py = None
+
+channels = [ 1, 2, 3, 4 ]
+
+def screen_contents(scope):
+  """ The displayed waveform of every channel of one ds1054z.DS1054Z,
+      as { 'Channel_n' : (samples, times) } """
+  data = dict()
+  times = None
+  for channel in channels:
+    samples = scope.get_waveform_samples(channel)
+    if times is None: # the same for every channel, and costly to fetch
+      times = scope.waveform_time_values
+    data["Channel_%d"%channel] = (samples, times)
+  return data
+
+class WaveformFetcher:
+  """ Downloads from several scopes at once """
+
+  timeout = 10 # seconds to wait for any one scope
+
+  def __init__(self, max_workers=8):
+    self.pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+    self.busy = dict() # key -> future of a download that may still be running
+
+  def fetch(self, scopes, fetch=screen_contents, timeout=None):
+    """ Call fetch(scope) for each of scopes ({ key : scope }) in parallel.
+        Returns (data, failures): { key : result } for the scopes that
+        finished in time, and { key : reason } for the rest. """
+    if timeout is None:
+      timeout = self.timeout
+    futures = dict()
+    failures = dict()
+    for key, scope in scopes.items():
+      previous = self.busy.get(key)
+      if previous is not None and not previous.done():
+        failures[key] = "still busy with an earlier download"
+        continue
+      futures[key] = self.busy[key] = self.pool.submit(fetch, scope)
+    concurrent.futures.wait(futures.values(), timeout)
+    data = dict()
+    for key, future in futures.items():
+      if not future.done():
+        failures[key] = "no data after %g s"%timeout
+      elif future.exception() is not None:
+        failures[key] = "download failed: %s"%future.exception()
+      else:
+        data[key] = future.result()
+    return data, failures
+
+
+formats = [ 'h5', 'npz' ]
+
+def scopeArrays(scope_data):
+  """ Convert one scope's { 'Channel_n' : (samples, times) } into
+      (times, samples, keys): a 1-d time axis and a (channels, points)
+      array, with the channel keys in row order """
+  keys = sorted(scope_data.keys())
+  samples = np.array([ scope_data[k][0] for k in keys ], dtype=np.float64)
+  times = np.asarray(scope_data[keys[0]][1], dtype=np.float64)[:samples.shape[1]]
+  return times, samples, keys
+
+def channelNames(scope, keys, names=None):
+  """ The dataset name for each of a scope's channel keys: its labels if it
+      has any, else the keys. Raises ValueError unless there is one label per
+      channel, with no repeats and none called 'time'. """
+  if not names:
+    return keys
+  if len(names) != len(keys):
+    raise ValueError("%s has %d channels but %d channel names (%s)"%(scope, len(keys), len(names), ' '.join(names)))
+  if len(set(names)) != len(names):
+    raise ValueError("%s has repeated channel names (%s)"%(scope, ' '.join(names)))
+  if 'time' in names:
+    raise ValueError("%s: 'time' cannot be a channel name"%scope)
+  return names
+
+def writeShot(path, data, labels=None, fmt='h5'):
+  """ Write every scope's data from one shot to path.h5 or path.npz.
+      data is { scope : { 'Channel_n' : (samples, times) } }, and labels
+      optionally { scope : [ name per channel ] }. In HDF5 each scope is a
+      group holding 'time' and a dataset per channel; in .npz the arrays are
+      named '<scope>/time' and '<scope>/<channel>'. Returns the file name. """
+  if fmt not in formats:
+    raise ValueError("Unknown format %s (choose from %s)"%(fmt, ', '.join(formats)))
+  if fmt == 'h5' and h5py is None:
+    raise ValueError("the h5 format needs the h5py package")
+  labels = labels or dict()
+  directory = os.path.dirname(path)
+  if directory and not os.path.exists(directory):
+    os.makedirs(directory)
+  arrays = dict()
+  for scope in sorted(data.keys()):
+    times, samples, keys = scopeArrays(data[scope])
+    names = channelNames(scope, keys, labels.get(scope))
+    arrays[scope] = (times, samples, names, keys)
+  filename = path + '.' + fmt
+  if fmt == 'npz':
+    contents = dict()
+    for scope, (times, samples, names, keys) in arrays.items():
+      contents[scope + '/time'] = times
+      for name, row in zip(names, samples):
+        contents[scope + '/' + name] = row
+    with open(filename, 'wb') as f:
+      np.savez(f, **contents)
+  else:
+    with h5py.File(filename, 'w') as h5f:
+      for scope, (times, samples, names, keys) in arrays.items():
+        g = h5f.create_group(scope)
+        g.create_dataset('time', data=times)
+        for name, key, row in zip(names, keys, samples):
+          g.create_dataset(name, data=row).attrs['channel'] = key
+  return filename
+
+def writeCSV(filename, scope_data, labels=None, header=True):
+  """ Write one scope's data as CSV rows of time followed by each channel,
+      formatting the whole table in one go rather than row by row """
+  times, samples, keys = scopeArrays(scope_data)
+  table = np.column_stack((times, samples.T))
+  heading = ','.join([ 'time' ] + list(labels or keys)) if header else ''
+  np.savetxt(filename, table, fmt='%.9g', delimiter=',', newline='\r\n',
+             header=heading, comments='')
+
+
+raw_chunk_size = 250000 # bytes per :WAVeform:DATA? read; the most a DS1000Z returns in RAW mode
+
+preamble_keys = [ 'fmt', 'typ', 'pnts', 'cnt', 'xinc', 'xorig', 'xref', 'yinc', 'yorig', 'yref' ]
+
+def decodeBlock(block):
+  """ The payload of an IEEE 488.2 definite length block (#<n><length><data>),
+      without copying it """
+  n = int(block[1:2])
+  length = int(block[2:2+n])
+  return memoryview(block)[2+n:2+n+length]
+
+def rawWaveform(scope, channel, chunk_size=raw_chunk_size):
+  """ Read the whole acquisition memory of one channel in RAW mode.
+      The scope must be stopped. Returns (raw, preamble): a uint8 array
+      and the :WAVeform:PREamble? values as a dict. """
+  scope.write(":WAVeform:SOURce CHAN%d"%channel)
+  scope.write(":WAVeform:FORMat BYTE")
+  scope.write(":WAVeform:MODE RAW")
+  preamble = dict(zip(preamble_keys, scope.waveform_preamble))
+  points = preamble['pnts']
+  raw = np.empty(points, dtype=np.uint8)
+  for start in range(0, points, chunk_size):
+    stop = min(points, start + chunk_size)
+    scope.write(":WAVeform:STARt %d"%(start + 1)) # 1-based and inclusive
+    scope.write(":WAVeform:STOP %d"%stop)
+    block = decodeBlock(scope.query_raw(":WAVeform:DATA?"))
+    if len(block) != stop - start:
+      raise IOError("CHAN%d: expected %d bytes at %d, got %d"%(channel, stop - start, start + 1, len(block)))
+    raw[start:stop] = np.frombuffer(block, dtype=np.uint8)
+  return raw, preamble
+
+def rawToVolts(raw, preamble):
+  return (raw.astype(np.float32) - (preamble['yorig'] + preamble['yref'])) * preamble['yinc']
+
+def rawTimes(raw, preamble):
+  return preamble['xorig'] + preamble['xinc'] * np.arange(len(raw))
+
+def raw_contents(scope):
+  """ The acquisition memory of every displayed channel of one scope, as
+      { 'Channel_n' : (raw, preamble) }. The scope is stopped for the read
+      and set running again afterwards if it was running before. """
+  was_running = scope.running
+  if was_running:
+    scope.stop()
+  try:
+    data = dict()
+    for name in scope.displayed_channels:
+      if name.startswith('CHAN'):
+        channel = int(name[4:])
+        data["Channel_%d"%channel] = rawWaveform(scope, channel)
+    return data
+  finally:
+    if was_running:
+      scope.run()
+
+def writeRawShot(path, data, labels=None):
+  """ Write raw_contents from every scope ({ scope : { 'Channel_n' : (raw, preamble) } })
+      to path.h5: a group per scope holding each channel's bytes, with the
+      preamble as attributes so rawToVolts and rawTimes can be applied later.
+      Returns the file name. """
+  if h5py is None:
+    raise ValueError("raw data is written as HDF5, which needs the h5py package")
+  labels = labels or dict()
+  directory = os.path.dirname(path)
+  if directory and not os.path.exists(directory):
+    os.makedirs(directory)
+  keys = [ "Channel_%d"%c for c in channels ]
+  names = { scope : dict(zip(keys, channelNames(scope, keys, labels.get(scope)))) for scope in data }
+  filename = path + '.h5'
+  with h5py.File(filename, 'w') as h5f:
+    for scope in sorted(data.keys()):
+      g = h5f.create_group(scope)
+      for key in sorted(data[scope].keys()):
+        raw, preamble = data[scope][key]
+        d = g.create_dataset(names[scope].get(key, key), data=raw, chunks=(max(min(len(raw), 1 << 20), 1),),
+                             compression='gzip', compression_opts=1)
+        d.attrs.update(preamble)
+        d.attrs['channel'] = key
+  return filename
@@ -1,11 +1,10 @@
-import bottom
+import bot_runtime
 import ipfsApi
 import time
 import sys
 import traceback
-import asyncio
 import system_control
-import csv
+import rigol_data
 import os
 
 host = '192.168.137.3'
@@ -28,66 +27,97 @@ state.names = dict()
 state.ips = dict()
 state.channel_names = dict()
 state.scopes = set()
+state.data_format = 'h5' # one of rigol_data.formats
 
 def on_rigol_connect(ip):
-  sysmsg("Connected to rigol scope at ip %s"%(ip))
+  bot.report("Connected to rigol scope at ip %s"%(ip), 'connect', 'OK', ip=ip) # setup_rigols waits for this
   state.scopes.add(ip)
 
 def on_error(s):
+  # may be called from a download thread, which sysmsg allows
   sysmsg('ERROR ' + s)
 
+bot = bot_runtime.BotRuntime(NICK, 'rigol ds1054z control bot', CHANNEL, host, port, ssl)
+sysmsg = bot.sysmsg
+
 state.r = system_control.RigolControl()
 state.r.onConnect(on_rigol_connect)
 state.r.onError(on_error)
 state.r.start()
 
-bot = bottom.Client(host=host, port=port, ssl=ssl)
-
-def sysmsg(s):
-  bot.send("PRIVMSG", target=CHANNEL, message=s)
-
-def usage(message):
-  sysmsg("%s understands the following commands:"%NICK)
-  for k,v in commands.items():
-    sysmsg('  ' + k + ' : ' + v[0])
-
 def write_data(message):
   # write data
   if len(state.scopes) == 0:
     sysmsg("No scopes connected")
     return
+  elems = message.split()
+  if len(elems) == 0 or elems[1:] not in [ [], ['csv'] ]:
+    sysmsg("ERROR: Need arguments <PATH> [csv]")
+    return
+  outdir = elems[0]
   data = state.r.scope_screen_contents()
-  outdir = message.strip()
+  if len(data) == 0:
+    sysmsg("ERROR: No data from any scope")
+    return
+  named = { state.names[ip] : d for ip, d in data.items() }
+  labels = { name : state.channel_names[name] for name in named }
   sysmsg("Writing rigol data to output directory %s"%outdir)
-  if not os.path.exists(outdir):
-    os.makedirs(outdir)
-  for scope in data.keys():
-    outfile = os.path.join(outdir, "%s.csv"%state.names[scope])
-    print("Writing %s"%outfile)
-    this_scope_data = data[scope]
-    with open(outfile,"w",newline='') as csvfile:
-      labels = []
-      labels.append("time")
-      for n in state.channel_names[state.names[scope]]:
-        labels.append(n)
-      csvfile.write("%s\r\n"%(','.join(labels)))
-      writer =  csv.writer(csvfile)
-      # get length of time series
-      length = len(data[scope]['Channel_1'][0])
-      for i in range(length):
-        line = []
-        line.append(data[scope]['Channel_1'][1][i])
-        for channel in sorted(this_scope_data.keys()):
-          thisline = data[scope][channel][0][i]
-          line.append(thisline)
-        writer.writerow(line)
-  sysmsg("Data written")
+  try:
+    filename = rigol_data.writeShot(os.path.join(outdir, 'rigol'), named, labels, state.data_format)
+  except ValueError as e:
+    sysmsg("ERROR: %s"%e)
+    return
+  if elems[1:] == ['csv']:
+    for name, d in named.items():
+      outfile = os.path.join(outdir, "%s.csv"%name)
+      print("Writing %s"%outfile)
+      rigol_data.writeCSV(outfile, d, labels[name])
+  sysmsg("Data written to %s"%filename)
+
+def write_data_raw(message):
+  if len(state.scopes) == 0:
+    sysmsg("No scopes connected")
+    return
+  if len(message.split()) != 1:
+    sysmsg("ERROR: Need argument <PATH>")
+    return
+  outdir = message.strip()
+  sysmsg("Reading deep memory of each rigol scope; this can take several minutes")
+  def read_and_write():
+    data = state.r.scope_raw_contents()
+    if len(data) == 0:
+      return None, data
+    named = { state.names[ip] : d for ip, d in data.items() }
+    labels = { name : state.channel_names[name] for name in named }
+    return rigol_data.writeRawShot(os.path.join(outdir, 'rigol_raw'), named, labels), named
+  def done(future):
+    if future.exception() is not None:
+      print("Unexpected error:", future.exception())
+      sysmsg("ERROR: could not write raw rigol data to %s: %s"%(outdir, future.exception()))
+      return
+    filename, named = future.result()
+    if filename is None:
+      sysmsg("ERROR: No data from any scope")
+      return
+    for name, d in sorted(named.items()):
+      sysmsg("  %s: %s"%(name, ', '.join("%s %d points"%(key, len(raw)) for key, (raw, preamble) in sorted(d.items()))))
+    sysmsg("Raw data written to %s"%filename)
+  # off the event loop, as the transfer takes far longer than a ping interval
+  bot.loop.run_in_executor(None, read_and_write).add_done_callback(
+    lambda f: bot.loop.call_soon_threadsafe(done, f))
+
+def set_data_format(message):
+  if message.strip() not in rigol_data.formats:
+    sysmsg("ERROR: Data format should be one of %s"%', '.join(rigol_data.formats))
+    return
+  state.data_format = message.strip()
+  sysmsg("Data format set to %s"%state.data_format)
 
 def add_device(message):
   elems = message.strip().split(' ')
   state.names[elems[0]] = elems[1]
   state.ips[elems[1]] = elems[0]
-  state.channel_names[elems[0]] = [ 'Channel_1', 'Channel_2', 'Channel_3', 'Channel_4' ]
+  state.channel_names[elems[1]] = [ 'Channel_1', 'Channel_2', 'Channel_3', 'Channel_4' ]
   state.r.thread.add_device(elems[0])
 
 def remove_device(message):
@@ -113,55 +143,23 @@ def status(message):
     sysmsg("No connected rigol scopes")
     return
 
-  sysmsg("Connected scopes: ")
+  lines = [ "Connected scopes: " ]
   for ip in state.scopes:
-    sysmsg("  %s  @  %s : "%(state.names[ip], ip))
+    lines.append("  %s  @  %s : "%(state.names[ip], ip))
     for ix,n in enumerate(state.channel_names[state.names[ip]]):
-      sysmsg("    Channel %d is labelled '%s'"%(ix+1,n))
+      lines.append("    Channel %d is labelled '%s'"%(ix+1,n))
+  bot.sysmsg_lines(lines)
 
 commands = {
     'channel_names' :   ( 'channel_names <DEVICE_NAME> <NAME_1> <NAME_2> ...    names the channels of the chosen scope', name_channels),
     'add_device' :      ( 'add_device <IP> <NAME>  adds the device at IP and names it NAME  (e.g add_device 192.168.137.10 pulse_scope)', add_device),
     'remove_device' :   ( 'remove_device <NAME> removes the named device', remove_device),
     'status'     :      ( 'shows information about connected Rigol scopes', status),
-    'write_data' :      ( 'write_data <PATH> writes the current screen contents of each rigol scope to <PATH>', write_data),
-    'help' : ( 'shows this useful message', usage),
+    'write_data' :      ( 'write_data <PATH> [csv] writes the current screen contents of every rigol scope to <PATH>/rigol.h5 (or .npz), plus a CSV file per scope if asked', write_data),
+    'write_data_raw' :  ( 'write_data_raw <PATH> reads the full acquisition memory of every displayed channel of every rigol scope (stopping them whilst it does) and writes it to <PATH>/rigol_raw.h5', write_data_raw),
+    'data_format' :     ( 'data_format <FORMAT> sets the file format used by write_data (one of %s)'%', '.join(rigol_data.formats), set_data_format),
 }
-
-@bot.on('CLIENT_CONNECT')
-def connect(**kwargs):
-    print("Connected")
-    bot.send('NICK', nick=NICK)
-    bot.send('USER', user=NICK,
-             realname='rigol ds1054z control bot')
-    bot.send('JOIN', channel=CHANNEL)
-
-@bot.on("client_disconnect")
-async def reconnect(**kwargs):
-    await asyncio.sleep(3, loop=bot.loop)
-    bot.loop.create_task(bot.connect())
-
-@bot.on('PING')
-def keepalive(message, **kwargs):
-    bot.send('PONG', message=message)
-
-@bot.on('PRIVMSG')
-def message(nick, target, message, **kwargs):
-    # Don't echo ourselves
-    if nick == NICK:
-        return
-    # Only respond to commands that are to us.
-    if not message.startswith(NICK + ': '):
-      return
-
-    stripped = ''.join(message.split(NICK+': ')[1:]).strip()
-
-    elems = stripped.split()
-    if elems[0] in commands.keys():
-      commands[elems[0]][1]( ' '.join(elems[1:]))
-    else:
-      sysmsg("ERROR: Command not understood")
+bot.add_commands(commands, blocking=[ 'write_data' ])
 
 print("Starting rigol control bot")
-bot.loop.create_task(bot.connect())
-bot.loop.run_forever()
\ No newline at end of file
+bot.run()
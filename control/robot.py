@@ -1,11 +1,12 @@
-import bottom
+import bot_runtime
+import bot_bus
 from macrosystem import *
 import sys
 import traceback
-import asyncio
 import time
 import threading
 import queue
+import collections
 
 host = '192.168.137.3'
 port = 6667
@@ -28,15 +29,17 @@ class SequenceThread(threading.Thread):
   def __init__(self):
     super().__init__()
     self.lock = threading.Lock()
-    self.queue = queue.Queue(3000)
+    self.queue = queue.Queue(3000)         # commands received over IRC
+    self.actions = collections.deque()     # actions queued by running macros; run first
 
   def clear_queue(self):
     self.lock.acquire()
+    self.actions.clear()
     while not self.queue.empty():
       self.queue.get()
     self.lock.release()
 
-  def consume(self,s):
+  def consume(self,s,listen=True):
     # bail out on error
     if s.strip().lower().startswith(NICK+': ' + 'help'):
       showhelp()
@@ -45,84 +48,71 @@ class SequenceThread(threading.Thread):
     if ('ERROR' in s) or state.should_abort:
       sysmsg("Aborting due to ERROR message")
       abort()
-      self.clear_queue()
-      sleep(2)
-      self.clear_queue()
-      state.should_abort = False
+      self.interrupt()
       return
 
     # bail out on request from channel
     for syn in abort_synonyms:
       if syn in s:
         abort()
-        self.clear_queue()
+        self.interrupt()
         return
 
     else:
-      if state.waiting:
-        if s.startswith(state.waiting_for):
-          state.waiting = False
-        elif s.startswith(NICK+ ': '):
-          stripped = ''.join(s.split(NICK+': ')[1:]).strip()
-          self.lock.acquire()
-          self.queue.put(stripped)
-          self.lock.release()
-      elif s.startswith(NICK + ': '):
+      if s.startswith(NICK + ': ') and not (state.waiting and s.startswith(state.waiting_for)):
         # enqueue for running
         stripped = ''.join(s.split(NICK+': ')[1:]).strip()
-        self.lock.acquire()
         self.queue.put(stripped)
-        self.lock.release()
-      else:  # not waiting and not for me directly
-        state.backlog.append(s)
+      elif listen:  # not for me directly; may be what we are waiting for
+        hear(s)
+
+  def enqueue(self, cmd):
+    # cmd is macro source text, or a pre-parsed Command. Only called from
+    # this thread (by the macro being run), so the run loop needs no waking.
+    self.actions.append(cmd)
+
+  def interrupt(self):
+    # drop queued commands, and wake the run loop so it clears the abort
+    self.clear_queue()
+    self.queue.put(None)
 
   def run(self):
     while True:
-      if state.should_abort:
+      # clear_queue() may empty actions from another thread between a
+      # check and a pop, so just try the pop
+      try:
+        cmd = self.actions.popleft()
+      except IndexError:
+        cmd = self.queue.get()
+      if cmd is None or state.should_abort:
         self.clear_queue()
         state.should_abort = False
       else:
-        if not self.queue.empty():
-          cmd = self.queue.get()
-          guarded_invoke(cmd,state.globals, state.locals)
-        time.sleep(0.2)
+        guarded_invoke(cmd,state.globals, state.locals)
 
-bot = bottom.Client(host=host, port=port, ssl=ssl)
+bot = bot_runtime.BotRuntime(NICK, 'universal control robot', CHANNEL, host, port, ssl)
 t = SequenceThread()
-state.nick = NICK
 t.start()
 state.parent = t
-state.backlog = []
-
-def sysmsg(s):
-  bot.send("PRIVMSG", target=CHANNEL, message=s)
 
-handlers['emit'] = sysmsg
+sysmsg = bot.sysmsg # macros running in SequenceThread emit too, which sysmsg allows
 
-@bot.on('CLIENT_CONNECT')
-def connect(**kwargs):
-  print("Connected")
-  bot.send('NICK', nick=NICK)
-  bot.send('USER', user=NICK,
-           realname='universal control robot')
-  bot.send('JOIN', channel=CHANNEL)
+# what macros emit is mostly commands for the other bots
+handlers['emit'] = lambda s: sysmsg(s, bot_runtime.CONTROL)
+handlers['emit_lines'] = bot.sysmsg_lines
 
-@bot.on("client_disconnect")
-async def reconnect(**kwargs):
-  await asyncio.sleep(3, loop=bot.loop)
-  bot.loop.create_task(bot.connect())
-
-@bot.on('PING')
-def keepalive(message, **kwargs):
-  bot.send('PONG', message=message)
-
-@bot.on('PRIVMSG')
-def message(nick, target, message, **kwargs):
-  if nick == NICK:
-      return
+# what other bots publish on the bus is kept for wait_for(); the IRC copy
+# of an event already heard is only looked at for commands and aborts
+bus = bot_bus.Subscriber(hear_event, host=host)
+bus.start()
+if not bot_bus.available():
+  print("pyzmq is not installed, so macros will wait on what is said over IRC alone")
 
-  t.consume(message)
+def consume(nick, target, message):
+  # commands, aborts and the replies macros wait for are all handled by SequenceThread
+  t.consume(message, listen=not bus.irc_copy(nick, message))
+  return True
 
+bot.add_message_handler(consume)
 
-bot.loop.create_task(bot.connect())
-bot.loop.run_forever()
\ No newline at end of file
+bot.run()
@@ -1,7 +1,8 @@
-import bottom
+import bot_runtime
+import bot_bus
 import threading
 import time
-import queue
+import collections
 
 host = '192.168.137.3'
 port = 6667
@@ -20,28 +21,23 @@ state = State()
 state.sequence = [[]]
 state.commands = dict()
 state.running = False
-state.message_queue = queue.Queue(100)
-state.lock = threading.Lock()
+state.events = collections.deque(maxlen=100) # heard since the sequence started, oldest first
+state.cond = threading.Condition()            # guards events and should_abort; notified on change
 state.should_abort = False
 
 
-bot = bottom.Client(host=host, port=port, ssl=ssl)
+bot = bot_runtime.BotRuntime(NICK, 'Sequence control robot', CHANNEL, host, port, ssl)
+sysmsg = bot.sysmsg # the StepRunner thread posts too, which sysmsg allows
 
-def sysmsg(s):
-  bot.send("PRIVMSG", target=CHANNEL, message=s)
-  
 def show_help(target, message):
-  for k,v in command_table.items():
-    sysmsg( k + " : " + v[0] )
+  bot.sysmsg_lines([ k + " : " + v[0] for k,v in command_table.items() ])
 
 def show(target, message):
   if state.sequence == [[]]:
     sysmsg("No sequence is currently loaded.")
     return
-  sysmsg("Currently loaded sequence has %d steps"%len(state.sequence))
-  for i,step in enumerate(state.sequence):
-    # show this step
-    sysmsg(str(i+1) + " : " + str(step))
+  bot.sysmsg_lines([ "Currently loaded sequence has %d steps"%len(state.sequence) ] +
+                   [ str(i+1) + " : " + str(step) for i,step in enumerate(state.sequence) ])
 
 def new_step(target, message):
   state.sequence.append([])
@@ -50,6 +46,36 @@ def append_action(target, message):
   print(message)
   state.sequence[-1].append(message)
 
+def next_event(match, timeout):
+  """ Wait for an event that match(event) accepts, consuming it and everything
+      heard before it; returns it, or None on timeout, abort or error """
+  deadline = time.time() + timeout
+  with state.cond:
+    while not state.should_abort:
+      while state.events:
+        e = state.events.popleft()
+        if e['text'] and "ERROR" in e['text']:
+          sysmsg("Refusing to proceed in the face of errors")
+          state.should_abort = True
+          state.cond.notify_all()
+          return None
+        if match(e):
+          return e
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      state.cond.wait(remaining)
+  return None
+
+def stop():
+  with state.cond:
+    state.should_abort = True
+    state.cond.notify_all()
+
+def clear_events():
+  with state.cond:
+    state.events.clear()
+
 class StepRunner(threading.Thread):
   def __init__(self, seq):
     super().__init__()
@@ -57,6 +83,40 @@ class StepRunner(threading.Thread):
     self.delay = 0.2
   def set_sequence(self, seq):
     self.sequence = seq
+
+  def wait(self, action):
+    """ 'wait Ns' pauses; 'wait Ns for TEXT' waits for a bot to post TEXT, and
+        'wait Ns on DEVICE COMMAND [RESULT [VALUE]]' for DEVICE to publish RESULT
+        (OK by default) for COMMAND on the bot bus. Given VALUE, events with
+        other values are passed over, e.g 'wait 60s on bank charge OK 0' waits
+        for the charge to finish rather than start. """
+    elems = action.split()
+    timeout = int(elems[1].replace('s',''))
+    if len(elems) > 2 and elems[2] == 'on':
+      device, command = elems[3:5]
+      result = elems[5] if len(elems) > 5 else 'OK'
+      value = elems[6] if len(elems) > 6 else None
+      what = "%s %s"%(device, command)
+      def match(e):
+        if e['device'] != device or e['command'] != command:
+          return False
+        return value is None or str(e['value']) == value or e['result'] != result
+      e = next_event(match, timeout)
+      if e is not None and e['result'] != result:
+        sysmsg("%s gave %s; refusing to proceed"%(what, e['result']))
+        stop()
+    elif 'for ' in action:
+      desired_message = action.split('for ')[1]
+      what = "message '%s'"%desired_message
+      e = next_event(lambda e: e['text'] == desired_message, timeout)
+    else:
+      with state.cond:
+        state.cond.wait_for(lambda: state.should_abort, timeout=timeout)
+      return
+    if e is None and not state.should_abort:
+      sysmsg("Timed out waiting for %s"%what)
+      stop()
+
   def run(self):
     sysmsg("Starting sequence.")
     state.running = True
@@ -64,54 +124,22 @@ class StepRunner(threading.Thread):
       for action in step:
         if state.should_abort:
           state.running = False
-          while not state.message_queue.empty():
-            state.lock.acquire()
-            state.message_queue.get()
-            state.lock.release()
+          clear_events()
           sysmsg('Sequence Aborted.')
           return
         else:
-          if action.startswith('wait') and len(action.split('for ')) == 1:
-            elems = action.split()
-            timeout = int(elems[1].replace('s',''))
-            while (timeout >0 and not state.should_abort):
-              time.sleep(0.2)
-              timeout = timeout - 0.2
-          elif action.startswith('wait '):
+          if action.startswith('wait'):
             try:
-              elems = action.split()
-              can_proceed = False
-              timeout = int(elems[1].replace('s',''))
-              desired_message = action.split('for ')[1]
-              #sysmsg("Waiting %d seconds for '%s'"%(timeout, desired_message))
-              while (timeout > 0 and not can_proceed and not state.should_abort):
-                while not state.message_queue.empty():
-                  state.lock.acquire()
-                  m = state.message_queue.get()
-                  state.lock.release()
-                  if "ERROR" in m:
-                    sysmsg("Refusing to proceed in the face of errors")
-                    state.should_abort = True
-                  if m == desired_message:
-                    can_proceed = True
-                    break
-                time.sleep(0.2)
-                timeout = timeout - 0.2
-              if timeout <= 0:
-                sysmsg("Timed out waiting for message '%s'"%desired_message)
-                state.should_abort = True
+              self.wait(action)
             except:
-              handle_err()
+              bot_runtime.handle_exception()
               sysmsg("Error processing wait command %s"%action)
-              state.should_abort = True
+              stop()
           else:
-            sysmsg(action)
+            sysmsg(action, bot_runtime.CONTROL)
           time.sleep(self.delay)
     state.running = False
-    while not state.message_queue.empty():
-      state.lock.acquire()
-      state.message_queue.get()
-      state.lock.release()
+    clear_events()
     sysmsg("Sequence complete.")
 
 
@@ -124,16 +152,13 @@ def run(target, message):
     sysmsg("No sequence is currently loaded")
     return
   state.should_abort = False
-  state.lock.acquire()
-  while not state.message_queue.empty():
-    state.message_queue.get()
-  state.lock.release()
+  clear_events()
   runner = StepRunner(state.sequence)
   runner.start()
 
 def abort(target, message):
   sysmsg("Aborting")
-  state.should_abort = True
+  stop()
 
 def demo(target, message):
   state.sequence = [
@@ -145,9 +170,9 @@ def demo(target, message):
     [ 'say: Sequence started'],
     [ 'bank: reset', 'wait 1s'],
     [ 'bank: set charge_power on', 'wait 1s', 'bank: set charge_enable on', 'wait 1s'],
-    [ 'bank: charge 50', 'wait 60s for charge: OK, value = 0', 'bank: pulse', 'wait 10s for pulse : OK, value = 0'],
-    [ 'bank: charge 60', 'wait 60s for charge: OK, value = 0', 'bank: pulse', 'wait 10s for pulse : OK, value = 0'],
-    [ 'bank: charge 70', 'wait 60s for charge: OK, value = 0', 'bank: pulse', 'wait 10s for pulse : OK, value = 0'],
+    [ 'bank: charge 50', 'wait 60s for charge : OK, value = 0', 'bank: pulse', 'wait 10s for pulse : OK, value = 0'],
+    [ 'bank: charge 60', 'wait 60s for charge : OK, value = 0', 'bank: pulse', 'wait 10s for pulse : OK, value = 0'],
+    [ 'bank: charge 70', 'wait 60s for charge : OK, value = 0', 'bank: pulse', 'wait 10s for pulse : OK, value = 0'],
     [ 'bank: set charge_power off', 'bank: set charge_enable off'],
     [ 'say: Sequence complete']
   ]
@@ -157,46 +182,32 @@ command_table = {
   'show': ('Show the currently loaded sequence', show),
   'help' : ('Show this helpful message',    show_help),
   'new_step': ('Start defining a new step for the sequence', new_step),
-  'append' : ('Append an action to the current step', append_action),
+  'append' : ("Append an action to the current step: a command for another bot, 'wait Ns', 'wait Ns for TEXT' or 'wait Ns on DEVICE COMMAND [RESULT [VALUE]]'", append_action),
   'start' : ('Start running the sequence', run),
   'clear' : ('Clear the current sequence', clear),
   'load_example' : ('Load a default sequence to illustrate usage', demo),
   'abort' : ('Emergency stop sequence', abort)
 }
 
-@bot.on('CLIENT_CONNECT')
-def connect(**kwargs):
-  print("Connected")
-  bot.send('NICK', nick=NICK)
-  bot.send('USER', user=NICK,
-           realname='Sequence control robot')
-  bot.send('JOIN', channel=CHANNEL)
-
-@bot.on("client_disconnect")
-async def reconnect(**kwargs):
-  await asyncio.sleep(3, loop=bot.loop)
-  bot.loop.create_task(bot.connect())
-
-@bot.on('PING')
-def keepalive(message, **kwargs):
-  bot.send('PONG', message=message)
-
-@bot.on('PRIVMSG')
-def message(nick, target, message, **kwargs):
-  """ Echo all messages """
-  # Don't echo ourselves
-  if nick == NICK:
-    return
+def hear(event):
+  with state.cond:
+    state.events.append(event)
+    state.cond.notify_all()
+
+def queue_message(nick, target, message):
+  """ Everything not addressed to us is kept for 'wait ... for' actions """
   if message.startswith(NICK + ': '):
-    stripped = message.split(NICK+': ')
-    if len(stripped) > 1:
-      command_bit = ''.join(stripped[1:]).strip().split()
-      if command_bit[0].lower() in command_table.keys():
-        command_table[command_bit[0].lower()][1](target,' '.join(command_bit[1:]))
-  else:
-    state.lock.acquire()
-    state.message_queue.put(message)
-    state.lock.release()
-
-bot.loop.create_task(bot.connect())
-bot.loop.run_forever()
\ No newline at end of file
+    return False
+  if not bus.irc_copy(nick, message): # not already heard from the bus
+    hear(dict(device=nick, command=None, id=None, params={}, result=None, value=None, text=message))
+  return True
+
+bus = bot_bus.Subscriber(hear, host=host)
+bus.start()
+
+for name, (help, f) in command_table.items():
+  bot.add_command(name, help, lambda message, f=f: f(CHANNEL, message))
+bot.unknown_command = lambda word, args: None
+bot.add_message_handler(queue_message)
+
+bot.run()
@@ -1,11 +1,10 @@
-import bottom
+import bot_runtime
+import concurrent.futures
+import pythoncom
 import win32com
 import win32com.client
 
 
-speaker = win32com.client.Dispatch('SAPI.SpVoice')
-
-
 host = '192.168.137.3'
 port = 6667
 ssl = False
@@ -13,36 +12,29 @@ ssl = False
 NICK = "talkbot"
 CHANNEL = "#system"
 
-bot = bottom.Client(host=host, port=port, ssl=ssl)
-@bot.on('CLIENT_CONNECT')
-def connect(**kwargs):
-    print("Connected")
-    bot.send('NICK', nick=NICK)
-    bot.send('USER', user=NICK,
-             realname='iamthetalkingrobot')
-    bot.send('JOIN', channel=CHANNEL)
-
-@bot.on("client_disconnect")
-async def reconnect(**kwargs):
-  # Trigger an event that may cascade to a client_connect.
-  # Don't continue until a client_connect occurs, which may be never.
-  print("lost connection")  
-
-@bot.on('PING')
-def keepalive(message, **kwargs):
-    print("Received ping")
-    bot.send('PONG', message=message)
-
-@bot.on('PRIVMSG')
-def message(nick, target, message, **kwargs):
-    """ Echo all messages """
-    # Don't echo ourselves
-    if nick == NICK:
-        return
-    stripped = message.split(NICK+':') 
-    if len(stripped) > 1:
-        speaker.Speak(''.join(stripped))
+class Voice:
+  speaker = None
+
+def start_voice():
+  # SAPI is a COM object, so it is created on the thread that uses it
+  pythoncom.CoInitialize()
+  Voice.speaker = win32com.client.Dispatch('SAPI.SpVoice')
+
+# one thread, so that sentences are spoken in the order they arrive
+voice = concurrent.futures.ThreadPoolExecutor(1, initializer=start_voice)
+
+bot = bot_runtime.BotRuntime(NICK, 'iamthetalkingrobot', CHANNEL, host, port, ssl)
+
+def speak(text):
+  Voice.speaker.Speak(text)
+
+def message(nick, target, message):
+  stripped = message.split(NICK+':')
+  if len(stripped) > 1:
+    voice.submit(speak, ''.join(stripped))
+  return True
+
+bot.add_message_handler(message)
 
 print("hi")
-bot.loop.create_task(bot.connect())
-bot.loop.run_forever()
\ No newline at end of file
+bot.run()
@@ -1,4 +1,5 @@
-import bottom
+import bot_runtime
+import concurrent.futures
 import system_control
 
 host = '192.168.137.3'
@@ -17,56 +18,42 @@ def helpmsg():
 
 s = system_control.StepperControl()  
 
-bot = bottom.Client(host=host, port=port, ssl=ssl)
-@bot.on('CLIENT_CONNECT')
-def connect(**kwargs):
-    print("Connected")
-    bot.send('NICK', nick=NICK)
-    bot.send('USER', user=NICK,
-             realname='stepper control IRC bot')
-    bot.send('JOIN', channel=CHANNEL)
-
-@bot.on("client_disconnect")
-async def reconnect(**kwargs):
-    await asyncio.sleep(3, loop=bot.loop)
-    bot.loop.create_task(bot.connect())
-
-@bot.on('PING')
-def keepalive(message, **kwargs):
-    bot.send('PONG', message=message)
-
-@bot.on('PRIVMSG')
-def message(nick, target, message, **kwargs):
-    # Don't echo ourselves
-    if nick == NICK:
-        return
-    # Only respond to commands that are to us.
-    if not message.startswith(NICK + ': '):
+bot = bot_runtime.BotRuntime(NICK, 'stepper control IRC bot', CHANNEL, host, port, ssl)
+sysmsg = bot.sysmsg
+
+def show_help(message):
+  for line in helpmsg():
+    sysmsg(line)
+
+# one move at a time, in the order they were asked for
+mover = concurrent.futures.ThreadPoolExecutor(1)
+
+def run_move(f, d):
+  try:
+    f(d)
+  except:
+    bot_runtime.handle_exception()
+    sysmsg("ERROR: the stepper move failed")
+
+def move(f):
+  def handler(message):
+    try:
+      d = int(message.split(' ')[0])
+    except:
+      sysmsg("Sorry, couldn't parse that! ('help' for supported commands)")
       return
-    stripped = message.split(NICK+': ')
-    if len(stripped) > 1:
-        cmd = ''.join(stripped)
-        if (cmd.strip().lower() == 'help'):
-            for line in helpmsg():
-              bot.send("PRIVMSG", target=target, message=line)
-        elif cmd.startswith('forward'):
-          try:
-            d = int(cmd.split(' ')[1])
-            if not s.is_connected():
-              bot.send("PRIVMSG", target=target, message="ERROR: not connected to the stepper controller")
-            else:
-              s.forward(d)
-          except:
-            bot.send("PRIVMSG",target=target, message="Sorry, couldn't parse that! ('help' for supported commands)")
-        elif cmd.startswith('backward'):
-          try:
-            d = int(cmd.split(' ')[1])
-            if not s.is_connected():
-              bot.send("PRIVMSG", target=target, message="ERROR: not connected to the stepper controller")
-            else:
-              s.backwards(d)
-          except:
-            bot.send("PRIVMSG",target=target, message="Sorry, couldn't parse that! ('help' for supported commands)")
-
-bot.loop.create_task(bot.connect())
-bot.loop.run_forever()
\ No newline at end of file
+    if not s.is_connected():
+      sysmsg("ERROR: not connected to the stepper controller")
+    else:
+      mover.submit(run_move, f, d)
+  return handler
+
+bot.add_command('help', 'shows this useful message', show_help)
+bot.add_command('forward', 'forward <MM> moves the stepper forward', move(s.forward))
+bot.add_command('backward', 'backward <MM> moves the stepper backward', move(s.backwards))
+# as macrosystem.process_line sends them
+bot.add_command('forwards', 'the same as forward', move(s.forward))
+bot.add_command('backwards', 'the same as backward', move(s.backwards))
+bot.unknown_command = lambda word, args: None
+
+bot.run()
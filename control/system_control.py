@@ -13,10 +13,13 @@ import logging
 import queue
 import io
 import sys
+import re
 import json
 import traceback
+import collections
 import ds1054z
 import ds1054z.discovery
+import rigol_data
 
 import timeit
 
@@ -102,84 +105,164 @@ class SequenceThread(threading.Thread):
 
       
 
+def flag(v):
+  """ 'True' or 'False', as the bank sends them """
+  if v == 'True':
+    return True
+  if v == 'False':
+    return False
+  raise ValueError("expected True or False, got %r"%v)
+
+def guess_value(v):
+  """ read a value for a field the schema does not know """
+  for convert in (flag, int, float):
+    try:
+      return convert(v)
+    except ValueError:
+      pass
+  return v
+
+# Every field the bank reports in its 'M { "<field>" : "<value>" }' status
+# lines (see mr_info in the controllino code), and how to read its value
+status_fields = {
+  'controller_state' : str,
+  'requested_charge_power' : int,
+  'requested_charge_enable' : int,
+  'panel_hv_mode' : str,
+  'hv_voltage_requested' : int,
+  'hv_voltage_measured' : float,
+  'hv_control_state' : str,
+  'hv_trigger_depressed' : flag,
+  'hv_start' : int,
+  'hv_stop' : int,
+  'state_is_sane' : flag,
+  'charging' : flag,
+}
+for bank in range(1, 5):
+  status_fields.update({
+    'bank_%d_control_state'%bank : str,
+    'bank_%d_trigger_depressed'%bank : flag,
+    'bank_%d_lower_voltage'%bank : int,
+    'bank_%d_upper_voltage'%bank : int,
+    'bank_%d_start'%bank : int,
+    'bank_%d_stop'%bank : int,
+  })
+
+status_pattern = re.compile(r'\{\s*"([^"]+)"\s*:\s*"([^"]*)"\s*\}$') # the one field mr_info sends
+
+def parse_status(data):
+  """ The fields of a status line, as (field, value) pairs with typed values """
+  m = status_pattern.match(data)
+  if m:
+    fields = [ m.groups() ]
+  else: # any other JSON object
+    fields = [ (k, str(v)) for k, v in json.loads(data).items() ]
+  return [ (k, status_fields.get(k, guess_value)(v)) for k, v in fields ]
+
+
+class Notifier(threading.Thread):
+  """ Calls listeners from its own thread, so that whoever has news (the
+      serial reader) never waits for them. If the listeners fall more than
+      depth notifications behind, the oldest are dropped. """
+
+  def __init__(self, depth=1000):
+    super().__init__()
+    self.daemon = True
+    self.pending = collections.deque(maxlen=depth) # (listeners, args), oldest first
+    self.cond = threading.Condition()
+    self.dropped = 0
+
+  def notify(self, listeners, *args):
+    """ Arrange for f(*args) to be called for each f in listeners """
+    if not listeners:
+      return
+    with self.cond:
+      if len(self.pending) == self.pending.maxlen:
+        self.dropped += 1
+      self.pending.append((listeners, args))
+      self.cond.notify()
+
+  def run(self):
+    while True:
+      with self.cond:
+        self.cond.wait_for(lambda: self.pending)
+        listeners, args = self.pending.popleft()
+      for f in listeners:
+        try:
+          f(*args)
+        except:
+          handle_err()
+
+
 class BankControlLog:
 
-  messages = dict()
-  listeners = dict()
-  current_state = dict()
   memory_depth = 100  # number of lines to save
   bank_is_ready = False
   decoder = json.JSONDecoder()
   
   def __init__(self):
     self.lock = threading.Lock()
+    self.messages = dict()        # category -> the last memory_depth messages
+    self.listeners = dict()       # category -> [ f(message) ]
+    self.field_listeners = dict() # field -> [ f(field, value) ]
+    self.current_state = dict()
     for category in [ "commands", "replies", "errors", "events", "info", "status" ]:
-      self.messages[category] = []
+      self.messages[category] = collections.deque(maxlen=self.memory_depth)
       self.listeners[category] = []
+    self.notifier = Notifier()
+    self.notifier.start()
 
   def history(self, label):
     """ Get the last few messages for a given category """
-    if label in keys(self.messages):
-      self.lock.acquire()
-      r = self.messages[label]
-      self.lock.release()
-      return r
+    if label in self.messages:
+      with self.lock:
+        return list(self.messages[label])
     else:
       return []
 
   def add_listener(self,category,f):
     if not category in self.listeners.keys():
-      log.warning("Adding new category %s"%category)
+      logging.warning("Adding new category %s"%category)
       self.listeners[category] =[]
+      self.messages[category] = collections.deque(maxlen=self.memory_depth)
     self.listeners[category].append(f)
 
+  def add_field_listener(self, field, f):
+    """ Call f(field, value) whenever the bank reports a new value for field """
+    self.field_listeners.setdefault(field, []).append(f)
+
   def get_current_state(self):
     self.current_state["ready"] = self.bank_is_ready 
     return self.current_state
 
   def append(self,data,label):
-    # Notify all listeners
-    if label in self.listeners.keys():
-      for f in self.listeners[label]:
-        try:
-          f(data)
-        except:
-          pass
-    # save the message for posterity
-    self.lock.acquire()
-    l = self.messages[label]
-    l.append(data)
-    if len(l) > self.memory_depth:
-      l = l[1:]
-    self.lock.release()
+    # save the message for posterity, then have the listeners told
+    with self.lock:
+      self.messages[label].append(data)
+    self.notifier.notify(self.listeners.get(label), data)
 
   def info(self,data):
     logging.debug(data)
     self.append(data, "info")
   
   def status(self,data):
-    # parse out the field, set in current_state
+    # parse out the fields, and note those that changed in current_state
     logging.info(data)
     try:
-      d = eval(data)
-      for k in d.keys():
-        v = d[k]
-        try:
-          v = eval(v)
-        except:
-          pass
-        if k in self.current_state.keys():
-         if self.current_state[k] != v:
-           self.current_state[k] = v
-           self.append(data,"status")
-        else:
-          self.current_state[k] = v
-          self.append(data,"status")
-        
-       
+      fields = parse_status(data)
     except:
       handle_err()
-      logging.warning("Could not evaluate message %s"%data)
+      logging.warning("Could not parse status message %s"%data)
+      return
+    changed = False
+    for k, v in fields:
+      if k in self.current_state and self.current_state[k] == v:
+        continue
+      self.current_state[k] = v
+      changed = True
+      self.notifier.notify(self.field_listeners.get(k), k, v)
+    if changed:
+      self.append(data,"status")
 
   def event(self,data):
     logging.info(data)
@@ -403,6 +486,7 @@ class RigolDS1000Thread(threading.Thread):
 
   def __init__(self):
     super().__init__()
+    self.fetcher = rigol_data.WaveformFetcher()
 
   def getScopeByIP(self, ip):
     print(self.scopes_by_ip.keys())
@@ -412,12 +496,24 @@ class RigolDS1000Thread(threading.Thread):
     else:
       return None
 
+  raw_timeout = 300 # seconds; reading deep memory can take minutes
+
   def getScopeScreenContents(self):
-    data = dict()
-    for ip,d in self.scopes_by_ip.items():
-      data[ip] = dict()
-      for channel in range(4):
-        data[ip]["Channel_%d"%(channel+1)] = (d.get_waveform_samples(channel+1),d.waveform_time_values)
+    # all scopes download at once; any that fail or time out are reported
+    # through the error callbacks and left out
+    return self.fetch(rigol_data.screen_contents, self.fetcher.timeout)
+
+  def getScopeRawContents(self):
+    return self.fetch(rigol_data.raw_contents, self.raw_timeout)
+
+  def fetch(self, f, timeout):
+    data, failures = self.fetcher.fetch(dict(self.scopes_by_ip), f, timeout)
+    for ip, reason in failures.items():
+      for g in self.error_callbacks:
+        try:
+          g("No data from scope %s: %s"%(ip, reason))
+        except:
+          handle_err()
     return data
 
   #def _update_scope_image(self,ip):
@@ -479,6 +575,8 @@ class RigolControl:
 #    return self.thread.scope_images[ip]
   def scope_screen_contents(self):
     return self.thread.getScopeScreenContents()
+  def scope_raw_contents(self):
+    return self.thread.getScopeRawContents()
 
 class BankControl:
   def __init__(self):
@@ -503,3 +601,6 @@ class BankControl:
 
   def add_status_callback(self, fn):
     self.log.add_listener("status", fn)
+
+  def add_field_callback(self, field, fn):
+    self.log.add_field_listener(field, fn)
@@ -1,9 +1,9 @@
-import bottom
+import bot_runtime
+import concurrent.futures
+import pythoncom
 import win32com
 import win32com.client
 
-speaker = win32com.client.Dispatch('SAPI.SpVoice')
-
 host = '192.168.137.3'
 port = 6667
 ssl = False
@@ -11,39 +11,31 @@ ssl = False
 NICK = "say"
 CHANNEL = "#system"
 
-bot = bottom.Client(host=host, port=port, ssl=ssl)
-
-def sysmsg(s):
-  bot.send("PRIVMSG", target=CHANNEL, message=s)
-
-@bot.on('CLIENT_CONNECT')
-def connect(**kwargs):
-    print("Connected")
-    bot.send('NICK', nick=NICK)
-    bot.send('USER', user=NICK,
-             realname='iamthetalkingrobot')
-    bot.send('JOIN', channel=CHANNEL)
-
-@bot.on("client_disconnect")
-async def reconnect(**kwargs):
-    await asyncio.sleep(3, loop=bot.loop)
-    bot.loop.create_task(bot.connect())
-
-@bot.on('PING')
-def keepalive(message, **kwargs):
-    bot.send('PONG', message=message)
-
-@bot.on('PRIVMSG')
-def message(nick, target, message, **kwargs):
-    """ Echo all messages """
-    # Don't echo ourselves
-    if nick == NICK:
-        return
-    if message.startswith(NICK + ": "):
-        stripped = message.split(NICK+': ')
-        if len(stripped) > 1:
-            speaker.Speak(''.join(stripped))
-            sysmsg("OK")
-
-bot.loop.create_task(bot.connect())
-bot.loop.run_forever()
\ No newline at end of file
+class Voice:
+  speaker = None
+
+def start_voice():
+  # SAPI is a COM object, so it is created on the thread that uses it
+  pythoncom.CoInitialize()
+  Voice.speaker = win32com.client.Dispatch('SAPI.SpVoice')
+
+# one thread, so that sentences are spoken in the order they arrive
+voice = concurrent.futures.ThreadPoolExecutor(1, initializer=start_voice)
+
+bot = bot_runtime.BotRuntime(NICK, 'iamthetalkingrobot', CHANNEL, host, port, ssl)
+sysmsg = bot.sysmsg
+
+def speak(text):
+  Voice.speaker.Speak(text)
+  bot.report("OK", 'say', 'OK') # sequences wait for this before moving on
+
+def message(nick, target, message):
+  if message.startswith(NICK + ": "):
+    stripped = message.split(NICK+': ')
+    if len(stripped) > 1:
+      voice.submit(speak, ''.join(stripped))
+  return True
+
+bot.add_message_handler(message)
+
+bot.run()
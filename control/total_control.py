@@ -6,7 +6,7 @@ import picoscope
 import bank_control
 import stepper_control
 import time
-import csv
+import rigol_data
 
 # A collection of useful utilities for controlling our system
 # Must be connected to Rigol scopes via Ethernet
@@ -17,6 +17,8 @@ class TotalControl:
   scopeIDs = dict()
   scopeAddress = dict()
   directory = 'c:/data'
+  settle_time = 0 # seconds to wait before reading the scopes, e.g to let them finish a capture
+  fetcher = rigol_data.WaveformFetcher()
 
   def __init__(self):
     self.connectToBank() 
@@ -86,6 +88,12 @@ class TotalControl:
   def setScopeName(self,ip,name):
     self.scopeNames[self.scopeIDs[ip]] = name;
 
+  def writeDataFile(self,directory,sequencenum,label='',fmt='h5'):
+    """ Write every scope's screen contents to <directory>/<seq><label>/rigol.h5 (or .npz) """
+    data = self.getScopeScreenContents()
+    seq = '{0:03d}'.format(sequencenum)
+    return rigol_data.writeShot(os.path.join(directory, seq+label, 'rigol'), data, fmt=fmt)
+
   def writeCSVFiles(self,directory,sequencenum,label=''):
     data = self.getScopeScreenContents()
     seq = '{0:03d}'.format(sequencenum)
@@ -93,26 +101,15 @@ class TotalControl:
     if not os.path.exists(outdir):
       os.makedirs(outdir)
     for scope in sorted(data.keys()):
-      this_scope_data = data[scope]
       outfile = os.path.join(outdir, "%s.csv"%scope)
-      with open(outfile,"w") as csvfile:
-        writer =  csv.writer(csvfile)
-        # get length of time series
-        length = len(data[scope]['Channel_1'][0])
-        for i in range(length):
-          line = []
-          line.append(data[scope]['Channel_1'][1][i])
-          for channel in sorted(this_scope_data.keys()):
-            line.append(data[scope][channel][0][i])
-          writer.writerow(line)
+      rigol_data.writeCSV(outfile, data[scope], header=False)
 
   def getScopeScreenContents(self):
-    time.sleep(1)
-    data = dict()
-    for d in self.ds1000zs:
-      data[self.scopeNames[d.idn]] = dict()
-      for channel in range(4):
-        data[self.scopeNames[d.idn]]["Channel_%d"%(channel+1)] = (d.get_waveform_samples(channel+1),d.waveform_time_values)
+    if self.settle_time:
+      time.sleep(self.settle_time)
+    data, failures = self.fetcher.fetch({ self.scopeNames[d.idn] : d for d in self.ds1000zs })
+    for name, reason in sorted(failures.items()):
+      print("No data from %s: %s"%(name, reason))
     return data
 
 
@@ -26,6 +26,8 @@
 #define COMMAND_CHARGE 8
 #define COMMAND_PULSE 16
 #define COMMAND_ABORT 32
+#define COMMAND_SET_TIMINGS 64 // pulse delay and width for every bank in one frame
+#define COMMAND_TAGGED 128 // prefix: <COMMAND_TAGGED> <tag> <command...>; the tag is echoed in the reply
 
 // OTHER EVENT CODES
 #define HV_BIAS_CHANGE 56
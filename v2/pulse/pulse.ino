@@ -52,6 +52,8 @@ long last_switch_change;
 
 bool should_abort = false;  // Drop whatever we're doing?
 
+int reply_tag = -1; // tag of the COMMAND_TAGGED frame being handled, or -1 if untagged
+
 double SF = 500.0 / 335.0;
 int lower[] = {BANK1_L, BANK2_L, BANK3_L, BANK4_L};
 int upper[] = {BANK1_U, BANK2_U, BANK3_U, BANK4_U};
@@ -72,9 +74,22 @@ uint8_t colPins[5] = {
 
 
 
+/* Send a reply, prefixed with the tag of the command being handled (if any) */
+void send_reply(char *data, uint16_t len) {
+  if (reply_tag < 0) {
+    lc.frameDecode(data, len);
+    return;
+  }
+  char tagged[MAX_FRAME_LENGTH];
+  tagged[0] = COMMAND_TAGGED;
+  tagged[1] = (uint8_t)reply_tag;
+  memcpy(tagged+2, data, len);
+  lc.frameDecode(tagged, len+2);
+}
+
 void send_response(uint8_t command, uint8_t parameter, uint8_t response_code, uint16_t val) {
   char data[5] = {command, parameter, response_code, val / 256, val % 256};
-  lc.frameDecode(data, 5);
+  send_reply(data, 5);
 }
 
 /* Function to send out one 8bit character */
@@ -181,7 +196,7 @@ void getParam(const uint8_t *data, uint16_t len) {
         reply[i+10] = (uint8_t)(v/256);
         reply[i+11] = (uint8_t)(v - reply[i+10]);
       }
-      lc.frameDecode(reply, 18);
+      send_reply(reply, 18);
       break;
 
     case SWITCH_STATE:
@@ -191,7 +206,7 @@ void getParam(const uint8_t *data, uint16_t len) {
       for(int i=0; i<NBANKS+1; i++) {
         data[i+2] = switch_state[i];
       }
-      lc.frameDecode(data, NBANKS+3);
+      send_reply(data, NBANKS+3);
       break;
 
     default:
@@ -393,6 +408,20 @@ void auto_pulse(const uint8_t *data, uint16_t len) {
   
 }
 
+void setTimings(const uint8_t *data, uint16_t len) {
+  // arguments are pulse delay and pulse width (both in ms) for each of the
+  // NBANKS+1 banks in turn: d1 w1 d2 w2 ... 
+  if (len != 2*(NBANKS+1) + 1) {
+    send_response(COMMAND_SET_TIMINGS, GENERAL, WRONG_NUMBER_OF_ARGUMENTS, len-1);
+    return;
+  }
+  for (int i=0; i<NBANKS+1; i++) {
+    bpd[i] = data[2*i+1];
+    bpw[i] = data[2*i+2];
+  }
+  send_response(COMMAND_SET_TIMINGS, GENERAL, OK, NBANKS+1);
+}
+
 void setDryRun(const uint8_t *data, uint16_t len) {
   if (len != 2) {
     send_response(COMMAND_DRY_RUN, GENERAL, WRONG_NUMBER_OF_ARGUMENTS, len-1);
@@ -533,6 +562,16 @@ void showHelp() {
 /* Frame handler function. What to do with received data? */
 void frame_handler(const uint8_t *data, uint16_t len) {
 
+  // Tagged command: handle the rest of the frame, echoing the tag in any
+  // immediate replies. Replies sent later from loop() (e.g. charge complete)
+  // are untagged.
+  if (len > 2 && data[0] == COMMAND_TAGGED) {
+    reply_tag = data[1];
+    frame_handler(data+2, len-2);
+    reply_tag = -1;
+    return;
+  }
+
   // Do something with data that is in framebuffer
   if (len >0) {
 
@@ -550,6 +589,7 @@ void frame_handler(const uint8_t *data, uint16_t len) {
     switch (data[0])  {
       case COMMAND_GET:                   getParam(data, len); break;
       case COMMAND_SET:                   setParam(data, len); break;
+      case COMMAND_SET_TIMINGS:           setTimings(data, len); break;
       case COMMAND_CHARGE:                charge(data, len); break;
       case COMMAND_DRY_RUN:               setDryRun(data, len); break;
       case COMMAND_PULSE:                 auto_pulse(data, len); break;